@@ -1,6 +1,7 @@
 import logging
 from aiogram import types
 from admin import is_admin
+from handlers.routing import geo_routing
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +18,7 @@ def normalize_value(value, numeric=False):
             return [value]
     return [value]
 
-async def change_contact(message: types.Message, supabase):
+async def change_contact(message: types.Message, repo):
     """
     /change Team1 old_contact new_contact
     """
@@ -34,12 +35,12 @@ async def change_contact(message: types.Message, supabase):
         _, team, old_contact, new_contact = parts
 
         # Получаем текущий массив контактов
-        resp = supabase.table("geo").select("contact").eq("team_name", team).execute()
-        if not resp.data:
+        rows = await repo.get_team_contacts(team)
+        if not rows:
             await message.reply("⚠️ Команда не найдена.")
             return
 
-        current_contacts = resp.data[0]["contact"]  # обычно это список
+        current_contacts = rows[0]["contact"]  # обычно это список
         if old_contact not in current_contacts:
             await message.reply("⚠️ Старый контакт не найден в списке.")
             return
@@ -53,9 +54,8 @@ async def change_contact(message: types.Message, supabase):
         # Обновляем таблицу, преобразовав в Postgres array literal
         array_literal = "{" + ",".join(updated_contacts) + "}"
 
-        supabase.table("geo").update({
-            "contact": array_literal
-        }).eq("team_name", team).execute()
+        await repo.update_team_contacts(team, array_literal)
+        geo_routing.invalidate()
 
         await message.reply(f"✅ Контакт обновлен для {team}")
 
@@ -63,7 +63,7 @@ async def change_contact(message: types.Message, supabase):
         logger.error(f"Error in change_contact: {str(e)}")
         await message.reply("❌ Ошибка при обновлении контакта.")
 
-async def add_contact(message: types.Message, supabase):
+async def add_contact(message: types.Message, repo):
     """
     /add Team1 new_contact
     Добавляет новый контакт к существующему массиву контактов.
@@ -82,26 +82,22 @@ async def add_contact(message: types.Message, supabase):
         _, team, contact = parts
 
         # Проверяем, есть ли уже запись для команды
-        existing = supabase.table("geo").select("contact").eq("team_name", team).execute()
+        existing = await repo.get_team_contacts(team)
 
-        if existing.data and len(existing.data) > 0:
-            old_contacts = existing.data[0].get("contact", [])
+        if existing and len(existing) > 0:
+            old_contacts = existing[0].get("contact", [])
             if contact in old_contacts:
                 await message.reply(f"⚠️ Контакт {contact} уже существует в {team}")
                 return
 
             new_contacts = old_contacts + [contact]  # объединяем массивы
-            supabase.table("geo").update({
-                "contact": new_contacts
-            }).eq("team_name", team).execute()
+            await repo.update_team_contacts(team, new_contacts)
+            geo_routing.invalidate()
             await message.reply(f"✅ Контакт {contact} добавлен к {team}")
         else:
             # Если команды нет — создаём новую запись
-            supabase.table("geo").insert({
-                "team_name": team,
-                "contact": [contact],
-                "geos": []  # можно оставить пустым массивом
-            }).execute()
+            await repo.create_team(team, [contact])
+            geo_routing.invalidate()
             await message.reply(f"✅ Команда {team} создана с контактом {contact}")
 
     except Exception as e:
@@ -110,7 +106,7 @@ async def add_contact(message: types.Message, supabase):
 
 
 
-async def delete_contact(message: types.Message, supabase):
+async def delete_contact(message: types.Message, repo):
     """
     /delete Team1 contact
     """
@@ -128,12 +124,12 @@ async def delete_contact(message: types.Message, supabase):
         contact = " ".join(contact_parts)
 
         # Получаем текущий массив контактов
-        resp = supabase.table("geo").select("contact").eq("team_name", team).execute()
-        if not resp.data:
+        rows = await repo.get_team_contacts(team)
+        if not rows:
             await message.reply("⚠️ Команда не найдена.")
             return
 
-        current_contacts = resp.data[0]["contact"]
+        current_contacts = rows[0]["contact"]
         if contact not in current_contacts:
             await message.reply("⚠️ Контакт не найден.")
             return
@@ -144,9 +140,8 @@ async def delete_contact(message: types.Message, supabase):
         # Формируем корректный Postgres array literal
         array_literal = "{" + ",".join(updated_contacts) + "}" if updated_contacts else "{}"
 
-        supabase.table("geo").update({
-            "contact": array_literal
-        }).eq("team_name", team).execute()
+        await repo.update_team_contacts(team, array_literal)
+        geo_routing.invalidate()
 
         await message.reply(f"✅ Контакт {contact} удален из {team}")
 
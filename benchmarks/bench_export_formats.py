@@ -0,0 +1,82 @@
+"""
+Benchmark: export writers on synthetic request rows.
+
+    python -m benchmarks.bench_export_formats [rows] [--memory]
+
+Compares the old pandas -> astype(str) -> openpyxl pipeline with the
+streaming writers from export. parquet is skipped without pyarrow.
+--memory also reports peak Python allocations (tracemalloc, much slower).
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from export import EXPORT_FORMATS, format_available
+
+DEFAULT_ROWS = 100_000
+GEOS = ["DE", "GB", "US", "AU", "CA", "PL", "IT", "ES", "FR", "NL"]
+
+
+def synthetic_rows(count: int):
+    start = datetime(2025, 1, 1)
+    for i in range(count):
+        yield {
+            "id": i,
+            "user_id": 100000 + i % 5000,
+            "username": f"partner_{i % 5000}",
+            "geo": " ".join(GEOS[j % len(GEOS)] for j in range(i % 4 + 1)),
+            "site": f"https://affiliate{i % 300}.example.com",
+            "brand": f"Brand{i % 120}",
+            "request_date": (start + timedelta(seconds=i)).isoformat()
+        }
+
+
+def legacy_xlsx(rows, path: str) -> int:
+    """Старый путь: весь результат в DataFrame, astype(str), to_excel"""
+    import pandas as pd
+
+    df = pd.DataFrame(list(rows))
+    for column in df.columns:
+        df[column] = df[column].astype(str)
+    df.to_excel(path, index=False, engine="openpyxl")
+    return len(df)
+
+
+def measure(label: str, writer, count: int, fmt: str, memory: bool):
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        written = writer(synthetic_rows(count), path)
+        elapsed = time.perf_counter() - start
+        peak = f"{tracemalloc.get_traced_memory()[1] / 1e6:>10.1f} MB" if memory else ""
+        tracemalloc.stop()
+        size = os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+    print(f"{label:<14} {elapsed:>8.2f}s {written / elapsed:>12.0f} rows/s {size / 1e6:>9.2f} MB {peak}")
+
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != "--memory"]
+    memory = "--memory" in sys.argv
+    count = int(args[0]) if args else DEFAULT_ROWS
+    print(f"{count} rows")
+    print(f"{'format':<14} {'time':>9} {'throughput':>17} {'file':>12} {'peak mem' if memory else '':>13}")
+
+    measure("legacy xlsx", legacy_xlsx, count, "xlsx", memory)
+    for fmt, writer in EXPORT_FORMATS.items():
+        if not format_available(fmt):
+            print(f"{fmt:<14} skipped (pyarrow is not installed)")
+            continue
+        measure(fmt, writer, count, fmt, memory)
+
+
+if __name__ == "__main__":
+    main()
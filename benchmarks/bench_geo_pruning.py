@@ -0,0 +1,94 @@
+"""
+Micro-benchmark: fuzzy GEO matching with and without candidate pruning,
+on today's COUNTRY_MAP and on a synthetic map ten times its size.
+
+    python -m benchmarks.bench_geo_pruning
+
+Only words that miss the exact lookup are timed; that is where rapidfuzz
+runs. Every word is checked against a full scan of all aliases, any
+difference fails the run.
+"""
+import json
+import random
+import string
+import time
+
+from rapidfuzz import process, fuzz
+
+from benchmarks.bench_normalize_geo import make_messages
+from handlers.geo_index import GEO_SCORE_THRESHOLD, GeoIndex, clean_word
+
+MESSAGES = 2000
+CYRILLIC = "АБВГДЕЖЗИКЛМНОПРСТУФХЦЧШЫЭЮЯ"
+
+
+def full_scan(geo_index: GeoIndex, word_clean: str):
+    """GeoIndex.match без отбора кандидатов — эталон"""
+    results = process.extract(
+        word_clean,
+        geo_index.aliases,
+        scorer=fuzz.ratio,
+        score_cutoff=GEO_SCORE_THRESHOLD,
+        limit=None
+    )
+    if not results:
+        return None
+    top_score = results[0][1]
+    return geo_index.alias_codes[max(index for _, score, index in results if score == top_score)]
+
+
+def scale_map(country_map, factor, seed=7):
+    """
+    Карта в factor раз больше: к настоящей добавляются выдуманные страны,
+    алиасы которых — настоящие с заменой примерно половины букв
+    """
+    rnd = random.Random(seed)
+    scaled = dict(country_map)
+    for copy in range(1, factor):
+        for code, names in country_map.items():
+            fake = []
+            for name in names:
+                letters = CYRILLIC if any(char in CYRILLIC for char in name.upper()) else string.ascii_uppercase
+                fake.append("".join(rnd.choice(letters) if rnd.random() < 0.5 else char for char in name))
+            scaled[f"{code}{copy}"] = fake
+    return scaled
+
+
+def run(label, country_map, words):
+    geo_index = GeoIndex(country_map, cache_size=0)  # меряем отбор, а не кэш
+    fuzzy = [word for word in words if geo_index.exact.get(word) is None]
+
+    start = time.perf_counter()
+    expected = [full_scan(geo_index, word) for word in fuzzy]
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pruned = [geo_index.match(word) for word in fuzzy]
+    pruned_seconds = time.perf_counter() - start
+
+    candidates = sum(len(geo_index.candidates(word)) for word in fuzzy) / len(fuzzy)
+    mismatches = sum(1 for a, b in zip(expected, pruned) if a != b)
+    print(
+        f"{label:<4} {len(geo_index.aliases):>5} aliases  "
+        f"full scan {1e6 * scan_seconds / len(fuzzy):>7.1f} us/word  "
+        f"pruned {1e6 * pruned_seconds / len(fuzzy):>7.1f} us/word  "
+        f"candidates {candidates:>6.1f}  mismatches {mismatches}"
+    )
+    return mismatches
+
+
+def main():
+    with open("COUNTRY_MAP.json", "r", encoding="utf-8") as f:
+        country_map = json.load(f)
+
+    words = [clean_word(word) for message in make_messages(country_map, MESSAGES) for word in message]
+    print(f"{len(words)} words, cutoff {GEO_SCORE_THRESHOLD}")
+
+    mismatches = run("1x", country_map, words)
+    mismatches += run("10x", scale_map(country_map, 10), words)
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
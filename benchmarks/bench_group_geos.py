@@ -0,0 +1,75 @@
+"""
+Benchmark: old combinations() search vs group_geos_by_team.
+
+    python -m benchmarks.bench_group_geos
+"""
+import random
+import time
+from itertools import combinations
+
+from handlers import group_geos_by_team
+
+TEAMS = 8
+LEGACY_MAX_GEOS = 14  # дальше старый алгоритм считается слишком долго
+
+
+def legacy_group(correct_geos, geo_team_map):
+    """Старый перебор всех комбинаций GEO из handle_geos"""
+    used_teams = set()
+    reply_parts = []
+
+    for r in range(len(correct_geos), 0, -1):
+        for geo_combo in combinations(correct_geos, r):
+            combo_teams = set.intersection(*(set(geo_team_map[geo]) for geo in geo_combo))
+            combo_teams -= used_teams
+            if combo_teams:
+                reply_parts.append((geo_combo, frozenset(combo_teams)))
+                used_teams.update(combo_teams)
+    return reply_parts
+
+
+def make_case(n, rnd):
+    geos = [f"G{i}" for i in range(n)]
+    teams = [f"Team{t} – @contact{t}" for t in range(1, TEAMS + 1)]
+    geo_team_map = {}
+    for geo in geos:
+        geo_team_map[geo] = dict.fromkeys(t for t in teams if rnd.random() < 0.4)
+    return geos, geo_team_map
+
+
+def as_pairs(lines):
+    """'GEO: a, b – T1, T2' -> ((a, b), {T1, T2}) для сравнения со старым выводом"""
+    pairs = []
+    for line in lines:
+        geo_part, teams_part = line[len("GEO: "):].split(" – ", 1)
+        pairs.append((tuple(geo_part.split(", ")), frozenset(teams_part.split(", "))))
+    return pairs
+
+
+def timed(func, *args, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func(*args)
+    return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+    rnd = random.Random(7)
+
+    print(f"{'GEOs':>5} {'legacy ms':>12} {'grouped ms':>12}")
+    for n in (2, 4, 8, 12, LEGACY_MAX_GEOS):
+        geos, geo_team_map = make_case(n, rnd)
+        old, old_time = timed(legacy_group, geos, geo_team_map, repeat=1)
+        new, new_time = timed(group_geos_by_team, geos, geo_team_map)
+        if as_pairs(new) != old:
+            raise SystemExit(f"output differs from legacy for {n} GEOs")
+        print(f"{n:>5} {1000 * old_time:>12.3f} {1000 * new_time:>12.3f}")
+
+    for n in (50, 100, 200):
+        geos, geo_team_map = make_case(n, rnd)
+        _, new_time = timed(group_geos_by_team, geos, geo_team_map)
+        print(f"{n:>5} {'-':>12} {1000 * new_time:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Micro-benchmark: old per-country normalize_geo vs GeoIndex (with and
+without its match cache), plus the artifact-backed GeoIndex (load time and
+parity with the JSON one).
+
+    python -m benchmarks.bench_normalize_geo
+"""
+import json
+import os
+import random
+import tempfile
+import time
+
+from rapidfuzz import process, fuzz
+
+from handlers import normalize_geo, GeoIndex
+from handlers.geo_artifact import build_artifact, load_geo_index
+
+MESSAGES = 2000
+
+
+def legacy_normalize_geo(user_words, COUNTRY_MAP):
+    """Старая реализация: extractOne по каждой стране для каждого слова"""
+    correct = []
+    incorrect = []
+
+    for word in user_words:
+        word_clean = word.strip().replace("ё", "е").upper()
+        best_match = None
+        best_score = 70
+
+        for geo_code, names in COUNTRY_MAP.items():
+            score = process.extractOne(word_clean, names, scorer=fuzz.ratio)
+            if score and score[1] >= best_score:
+                best_match = geo_code
+                best_score = score[1]
+
+        if best_match:
+            correct.append(best_match)
+        else:
+            incorrect.append(word)
+
+    return correct, incorrect
+
+
+def make_messages(country_map, count, seed=42):
+    """Смесь точных кодов, названий с опечатками и обычных слов"""
+    rnd = random.Random(seed)
+    aliases = [name for names in country_map.values() for name in names]
+    chatter = ["hello", "привет", "need", "traffic", "deal", "cpa", "please", "ok", "спасибо"]
+    messages = []
+    for _ in range(count):
+        words = []
+        for _ in range(rnd.randint(3, 12)):
+            kind = rnd.random()
+            if kind < 0.5:
+                words.append(rnd.choice(aliases).lower())
+            elif kind < 0.8:
+                alias = rnd.choice(aliases)
+                pos = rnd.randrange(len(alias))
+                words.append(alias[:pos] + alias[pos + 1:])
+            else:
+                words.append(rnd.choice(chatter))
+        messages.append(words)
+    return messages
+
+
+def run(label, func, messages, arg):
+    start = time.perf_counter()
+    results = [func(words, arg) for words in messages]
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {len(messages) / elapsed:>10.1f} msg/s  ({elapsed:.3f}s)")
+    return results
+
+
+def main():
+    with open("COUNTRY_MAP.json", "r", encoding="utf-8") as f:
+        country_map = json.load(f)
+
+    messages = make_messages(country_map, MESSAGES)
+    words = sum(len(m) for m in messages)
+    print(f"{MESSAGES} messages, {words} words, {len(country_map)} countries")
+
+    start = time.perf_counter()
+    geo_index = GeoIndex(country_map)
+    print(f"index build {1000 * (time.perf_counter() - start):.2f} ms")
+
+    legacy = run("legacy", legacy_normalize_geo, messages, country_map)
+    uncached = run("uncached", normalize_geo, messages, GeoIndex(country_map, cache_size=0))
+    indexed = run("indexed", normalize_geo, messages, geo_index)
+    print(f"match cache: {geo_index.stats()}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        artifact_path = os.path.join(tmp, "COUNTRY_MAP.geoidx")
+        start = time.perf_counter()
+        build_artifact("COUNTRY_MAP.json", artifact_path)
+        print(f"artifact build {1000 * (time.perf_counter() - start):.2f} ms, {os.path.getsize(artifact_path)} bytes")
+
+        start = time.perf_counter()
+        with open("COUNTRY_MAP.json", "r", encoding="utf-8") as f:
+            GeoIndex(json.load(f))
+        print(f"load json + index {1000 * (time.perf_counter() - start):.2f} ms")
+        start = time.perf_counter()
+        artifact_index = load_geo_index("COUNTRY_MAP.json", artifact_path)
+        print(f"load artifact {1000 * (time.perf_counter() - start):.2f} ms")
+
+        from_artifact = run("artifact", normalize_geo, messages, artifact_index)
+
+    mismatches = sum(1 for a, b in zip(legacy, indexed) if a != b)
+    mismatches += sum(1 for a, b in zip(legacy, uncached) if a != b)
+    print(f"mismatches: {mismatches}")
+    artifact_mismatches = sum(1 for a, b in zip(indexed, from_artifact) if a != b)
+    print(f"artifact mismatches: {artifact_mismatches}")
+    if mismatches or artifact_mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark: graceful stop with acknowledged updates still in flight.
+
+    python -m benchmarks.bench_shutdown [users]
+
+Starts bot.main() in a fresh interpreter, on top of the in-memory Supabase
+stand-in and a local Bot API stub (every call sleeps 50 ms), with the
+SQLite FSM storage. Each virtual user posts a chatty message, /start and a
+website, and SIGTERM follows as soon as the last POST has been answered,
+long before the workers, the batch writers (5 s window) and the FSM
+write-behind (60 s here) could finish on their own.
+
+Prints how long the stop took and fails unless every update got its reply,
+every chatty message reached `messages` and every user's FSM state reached
+the SQLite file.
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession
+
+DEFAULT_USERS = 200
+
+CHILD = r"""
+import asyncio, json, os
+import bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+from benchmarks.loadtest import FakeSupabase, StubTelegram
+from repository import Repository
+
+async def run():
+    stub = StubTelegram(0.05)
+    runner = web.AppRunner(stub.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    api = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    db = FakeSupabase(0.01, ["US"])
+    bot.create_repository = lambda: Repository(db, max_workers=8)
+    make_bot = bot.Bot
+    bot.Bot = lambda token: make_bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api)))
+    try:
+        await bot.main()
+    finally:
+        await runner.cleanup()
+        print("RESULT " + json.dumps({
+            "calls": dict(stub.calls),
+            "tables": {name: len(rows) for name, rows in db.tables.items()}
+        }), flush=True)
+
+asyncio.run(run())
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"user{user_id}"},
+            "text": text
+        }
+    }
+
+
+async def post_all(url: str, users: int) -> int:
+    texts = ["what kind of deals do you have", "/start", "https://affiliate.example.com"]
+    async with ClientSession() as http:
+        async def user(user_id):
+            for i, text in enumerate(texts):
+                async with http.post(url, json=update(user_id * 10 + i, user_id, text)) as response:
+                    assert response.status == 200, response.status
+        await asyncio.gather(*(user(1000 + n) for n in range(users)))
+    return users * len(texts)
+
+
+async def wait_ready(port: int, child):
+    while child.poll() is None:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise SystemExit(f"bot exited with {child.returncode}")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_USERS
+    port = free_port()
+    fsm_path = os.path.join(tempfile.mkdtemp(), "fsm.sqlite3")
+    env = dict(
+        os.environ,
+        SUPABASE_URL="http://supabase.invalid", SUPABASE_KEY="bench", TELEGRAM_TOKEN="123456:BENCH",
+        PORT=str(port), FSM_STORAGE="sqlite", FSM_SQLITE_PATH=fsm_path, FSM_FLUSH_INTERVAL="60",
+        SEND_GLOBAL_LIMIT="1000000:1000000", SEND_CHAT_LIMIT="1000000:1000000"
+    )
+    for name in ("GEO", "OTHER", "EXPORT"):
+        env[f"RATE_LIMIT_{name}"] = env[f"RATE_LIMIT_{name}_GLOBAL"] = "1000000:1000000"
+
+    child = subprocess.Popen(
+        [sys.executable, "-c", CHILD], env=env, text=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    asyncio.run(wait_ready(port, child))
+    posted = asyncio.run(post_all(f"http://127.0.0.1:{port}/webhook", users))
+
+    stopped = time.perf_counter()
+    child.send_signal(signal.SIGTERM)
+    out, _ = child.communicate(timeout=120)
+    stop_seconds = time.perf_counter() - stopped
+
+    lines = [line for line in out.splitlines() if line.startswith("RESULT ")]
+    if child.returncode != 0 or not lines:
+        raise SystemExit(f"bot exited with {child.returncode}")
+    result = json.loads(lines[-1][len("RESULT "):])
+    with sqlite3.connect(fsm_path) as conn:
+        states = conn.execute("SELECT COUNT(*) FROM fsm_states WHERE state IS NOT NULL").fetchone()[0]
+
+    replies = result["calls"].get("sendMessage", 0)
+    messages = result["tables"].get("messages", 0)
+    print(f"{posted} updates acknowledged, SIGTERM, stopped in {stop_seconds:.2f}s")
+    print(f"  replies sent    {replies:>6} / {posted}")
+    print(f"  messages rows   {messages:>6} / {users}")
+    print(f"  FSM states      {states:>6} / {users}")
+    print(f"  deleteWebhook   {result['calls'].get('deleteWebhook', 0):>6}")
+    if (replies, messages, states) != (posted, users, users):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+"""
+Load test: mixed synthetic traffic through the real dispatcher and webhook.
+
+    python -m benchmarks.loadtest [--users 200] [--duration 20] [--workers 32]
+                                  [--db-latency 0.02] [--api-latency 0.03] [--telegram-limits]
+
+Builds the bot with bot.build_dispatcher / bot.create_app on top of an
+in-memory Supabase stand-in (every query sleeps --db-latency in the
+repository thread pool) and a local stub of the Telegram Bot API (every
+call sleeps --api-latency). Virtual users then POST updates to the webhook
+route: /start -> website -> brand -> GEO list flows, chatty free-text
+messages and admin exports. Each user waits for its previous update to be
+processed before sending the next one.
+
+Latency is measured per update from the webhook POST until the dispatcher
+has finished handling it, including every reply sent to the stub API.
+Rate limits are lifted unless --telegram-limits is given, so the numbers
+show what the code can do rather than what Telegram allows.
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import resource
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+from aiohttp import ClientSession, web
+
+# bot.py читает окружение при импорте
+os.environ.setdefault("SUPABASE_URL", "http://supabase.invalid")
+os.environ.setdefault("SUPABASE_KEY", "loadtest")
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:LOADTEST")
+
+ADMIN_ID = 923423138
+TEAMS = 8
+GEO_LENGTHS = [1, 1, 2, 3, 5, 10, 30]
+CHATTY = [
+    "hello, is anyone here?",
+    "what kind of deals do you have for casino traffic",
+    "can you send me the list of managers please",
+    "thanks a lot, have a great day"
+]
+
+
+# --- Supabase stand-in ---
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class FakeQuery:
+    """The subset of the postgrest builder the bot uses; execute() sleeps `latency`"""
+
+    def __init__(self, db, table: str):
+        self.db = db
+        self.path = f"/{table}"
+        self.table = table
+        self.op = "select"
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.row_limit = None
+        self.count = None
+        self.http_method = SimpleNamespace(value="GET")
+        self.headers = {}
+
+    def select(self, *columns, count=None):
+        self.count = count
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload, self.http_method = "insert", rows, SimpleNamespace(value="POST")
+        return self
+
+    def upsert(self, rows, on_conflict=""):
+        self.op, self.payload, self.http_method = "upsert", rows, SimpleNamespace(value="POST")
+        self.headers = {"prefer": "resolution=merge-duplicates"}
+        self.conflict = on_conflict.split(",")
+        return self
+
+    def update(self, values):
+        self.op, self.payload, self.http_method = "update", values, SimpleNamespace(value="PATCH")
+        return self
+
+    def delete(self):
+        self.op, self.http_method = "delete", SimpleNamespace(value="DELETE")
+        return self
+
+    def _where(self, test):
+        self.filters.append(test)
+        return self
+
+    def eq(self, column, value):
+        return self._where(lambda row: row.get(column) == value)
+
+    def gt(self, column, value):
+        return self._where(lambda row: row.get(column) > value)
+
+    def lt(self, column, value):
+        return self._where(lambda row: row.get(column) < value)
+
+    def lte(self, column, value):
+        return self._where(lambda row: row.get(column) <= value)
+
+    def in_(self, column, values):
+        return self._where(lambda row: row.get(column) in values)
+
+    def filter(self, column, operator, value):
+        values = set(value.strip("{}").split(","))
+        if operator == "ov":
+            return self._where(lambda row: bool(values & set(row.get(column) or [])))
+        if operator == "cs":
+            return self._where(lambda row: values <= set(row.get(column) or []))
+        return self._where(lambda row: str(row.get(column)) == value)
+
+    def order(self, column, desc=False):
+        # как в postgrest: order=<column>[.desc]; column может сам быть списком "a.desc,b"
+        spec = f"{column}{'.desc' if desc else ''}"
+        self.order_by = [(part.split(".")[0], part.endswith(".desc")) for part in spec.split(",")]
+        return self
+
+    def limit(self, count):
+        self.row_limit = count
+        return self
+
+    def execute(self):
+        time.sleep(self.db.latency)
+        with self.db.lock:
+            self.db.queries[(self.table, self.op)] += 1
+            rows = self.db.tables[self.table]
+            if self.op in ("insert", "upsert"):
+                new = self.payload if isinstance(self.payload, list) else [self.payload]
+                if self.op == "upsert":
+                    keys = [(tuple(r[k] for k in self.conflict)) for r in new]
+                    rows[:] = [r for r in rows if tuple(r.get(k) for k in self.conflict) not in keys]
+                for r in new:
+                    rows.append(dict(r))
+                    # serial id, как у таблиц в Supabase
+                    rows[-1].setdefault("id", next(self.db.ids))
+                return FakeResponse(new)
+
+            matched = [row for row in rows if all(test(row) for test in self.filters)]
+            if self.op == "update":
+                for row in matched:
+                    row.update(self.payload)
+                return FakeResponse(matched)
+            if self.op == "delete":
+                rows[:] = [row for row in rows if row not in matched]
+                return FakeResponse(matched)
+
+            total = len(matched)
+            for column, desc in reversed(self.order_by or []):
+                matched = sorted(matched, key=lambda row: row.get(column), reverse=desc)
+            if self.row_limit is not None:
+                matched = matched[:self.row_limit]
+            return FakeResponse([dict(row) for row in matched], total if self.count else None)
+
+
+class FakeSupabase:
+    def __init__(self, latency: float, country_codes, seed: int = 1):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.queries = Counter()
+        self.tables = defaultdict(list)
+        self.ids = itertools.count(1)
+        rng = random.Random(seed)
+        for i in range(1, TEAMS + 1):
+            self.tables["geo"].append({
+                "team_name": f"Team{i}",
+                "contact": [f"@manager{i}"],
+                "geos": rng.sample(country_codes, k=len(country_codes) // 2)
+            })
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+
+# --- Telegram Bot API stub ---
+
+class StubTelegram:
+    """Answers every Bot API call like Telegram would, after `latency` seconds"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post() if request.can_read_body else {}
+        await asyncio.sleep(self.latency)
+
+        if not method.lower().startswith("send"):
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(form.get("chat_id", 0))
+        result = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": form.get("text", "")
+        }
+        if method.lower() == "senddocument":
+            file_id = f"file{result['message_id']}"
+            result["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+# --- traffic ---
+
+class Traffic:
+    """Builds raw updates and remembers when each one was posted"""
+
+    def __init__(self, country_codes, seed: int = 2):
+        self.rng = random.Random(seed)
+        self.country_codes = country_codes
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Load", "username": f"user{user_id}"},
+                "text": text
+            }
+        }
+
+    def geo_list(self) -> str:
+        return ", ".join(self.rng.sample(self.country_codes, k=self.rng.choice(GEO_LENGTHS)))
+
+    def session(self, user_id: int):
+        """One user's next burst of (kind, text)"""
+        roll = self.rng.random()
+        if user_id == ADMIN_ID:
+            return [("export", self.rng.choice(["/download Team1", "/download all zip csv", "/messages csv"]))]
+        if roll < 0.6:
+            return [
+                ("start", "/start"),
+                ("website", f"https://affiliate{user_id}.example.com"),
+                ("brand", f"Brand{user_id % 50}"),
+                ("geo", self.geo_list())
+            ]
+        return [("chatty", self.rng.choice(CHATTY))]
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    os.environ["UPDATE_WORKERS"] = str(args.workers)
+    if not args.telegram_limits:
+        for name in ("GEO", "OTHER", "EXPORT"):
+            os.environ[f"RATE_LIMIT_{name}"] = "1000000:1000000"
+            os.environ[f"RATE_LIMIT_{name}_GLOBAL"] = "1000000:1000000"
+        os.environ["SEND_GLOBAL_LIMIT"] = "1000000:1000000"
+        os.environ["SEND_CHAT_LIMIT"] = "1000000:1000000"
+
+    import bot as bot_module
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from repository import Repository
+
+    # каждый апдейт логируется на INFO — в нагрузочном тесте это только шум
+    logging.getLogger().setLevel(logging.WARNING)
+
+    geo_index = bot_module.load_geo_index()
+    country_codes = sorted(geo_index.country_map)
+    db = FakeSupabase(args.db_latency, country_codes)
+    repo = Repository(db, max_workers=args.db_workers)
+
+    stub = StubTelegram(args.api_latency)
+    stub_runner = web.AppRunner(stub.app())
+    await stub_runner.setup()
+    stub_site = web.TCPSite(stub_runner, "127.0.0.1", 0)
+    await stub_site.start()
+    api_port = stub_site._server.sockets[0].getsockname()[1]
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{api_port}"))
+    bot = Bot(token=os.environ["TELEGRAM_TOKEN"], session=session)
+    dp = bot_module.build_dispatcher(repo, geo_index)
+
+    # момент окончания обработки каждого апдейта
+    posted = {}
+    latencies = defaultdict(list)
+    done_events = {}
+    feed_raw_update = dp.feed_raw_update
+
+    async def timed_feed(bot, update, **kwargs):
+        try:
+            return await feed_raw_update(bot, update, **kwargs)
+        finally:
+            kind, start = posted.pop(update["update_id"])
+            latencies[kind].append(time.perf_counter() - start)
+            done_events.pop(update["update_id"]).set()
+
+    dp.feed_raw_update = timed_feed
+
+    app = bot_module.create_app(bot, dp, webhook_url=f"http://127.0.0.1:{api_port}/webhook")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    webhook = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{bot_module.WEBHOOK_PATH}"
+
+    traffic = Traffic(country_codes)
+    rejected = Counter()
+    deadline = time.perf_counter() + args.duration
+
+    async def user(http: ClientSession, user_id: int):
+        while time.perf_counter() < deadline:
+            for kind, text in traffic.session(user_id):
+                update = traffic.message(user_id, text)
+                done = done_events[update["update_id"]] = asyncio.Event()
+                posted[update["update_id"]] = (kind, time.perf_counter())
+                async with http.post(webhook, json=update) as response:
+                    if response.status != 200:
+                        rejected[kind] += 1
+                        posted.pop(update["update_id"], None)
+                        done_events.pop(update["update_id"], None)
+                        await asyncio.sleep(0.1)
+                        continue
+                await done.wait()
+            await asyncio.sleep(args.think_time * traffic.rng.random())
+
+    users = [100000 + i for i in range(args.users)] + [ADMIN_ID]
+    started = time.perf_counter()
+    async with ClientSession() as http:
+        await asyncio.gather(*(user(http, user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    await stub_runner.cleanup()
+    await bot.session.close()
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"{args.users} users + 1 admin, {args.workers} update workers, {elapsed:.1f}s, db latency {args.db_latency * 1000:.0f} ms, "
+          f"api latency {args.api_latency * 1000:.0f} ms, telegram limits {'on' if args.telegram_limits else 'off'}")
+    print(f"updates processed: {total} ({total / elapsed:.1f}/s), "
+          f"GEO requests: {len(latencies['geo'])} ({len(latencies['geo']) / elapsed:.1f}/s), "
+          f"rejected with 503: {sum(rejected.values())}")
+    print(f"{'kind':<10} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for kind in ("start", "website", "brand", "geo", "chatty", "export"):
+        values = latencies.get(kind, [])
+        print(f"{kind:<10} {len(values):>7} {percentile(values, 0.5) * 1000:>9.1f} "
+              f"{percentile(values, 0.95) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f}")
+    all_values = list(itertools.chain.from_iterable(latencies.values()))
+    print(f"{'all':<10} {len(all_values):>7} {percentile(all_values, 0.5) * 1000:>9.1f} "
+          f"{percentile(all_values, 0.95) * 1000:>9.1f} {percentile(all_values, 0.99) * 1000:>9.1f}")
+    if all_values:
+        print(f"mean {statistics.mean(all_values) * 1000:.1f} ms")
+    print(f"Bot API calls: {sum(stub.calls.values())} {dict(stub.calls)}")
+    print(f"Supabase queries: {sum(db.queries.values())}")
+    # ru_maxrss в килобайтах на Linux
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    parser.add_argument("--think-time", type=float, default=0.5, help="max pause between a user's sessions")
+    parser.add_argument("--workers", type=int, default=32, help="update worker pool size (UPDATE_WORKERS)")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="seconds per Supabase query")
+    parser.add_argument("--db-workers", type=int, default=8, help="Repository thread pool size")
+    parser.add_argument("--api-latency", type=float, default=0.03, help="seconds per Bot API call")
+    parser.add_argument("--telegram-limits", action="store_true", help="keep rate limits and send pacing on")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
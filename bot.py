@@ -1,17 +1,17 @@
 import logging
 import os
 import asyncio
-import json
+import signal
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 from aiogram import F
-from supabase import create_client
 from dotenv import load_dotenv
 from aiohttp import web
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 
 
+import handlers
 from handlers import (
     cmd_start,
     website_handler,
@@ -19,14 +19,30 @@ from handlers import (
     geo_handler,
     #geo_button,
     handle_geos,
-    normalize_geo,
+    GeoIndex,
+    ParsedMessage,
+    ParseGeoMiddleware,
+    DEFAULT_LIMITS,
+    RateLimit,
+    ThrottlingMiddleware,
+    geo_routing,
     StartFlow,
     get_start_new_request_keyboard
 )
+from handlers.geo_artifact import load_geo_index as load_geo_artifact
 from handlers.excel import handle_download, handle_messages_download
+from export import export_cache
+from getexcel import send_all_tables
 from handlers.other import handle_other_message
 from adminpanel import change_contact, add_contact, delete_contact
 from admin import is_admin
+from repository import Repository
+import metrics
+from metrics import HandlerTimingMiddleware, RequestTimingMiddleware
+from sending import GLOBAL_LIMIT, PRIVATE_CHAT_LIMIT, SendScheduler
+from storage import SQLiteFSMBackend, SupabaseFSMBackend, WriteBehindStorage
+from writers import messages_writer, request_writer
+from updates import DEFAULT_WORKERS, UpdateDeduplicator, UpdateWorkerPool
 
 # Configure logging
 logging.basicConfig(
@@ -38,14 +54,6 @@ logger = logging.getLogger(__name__)
 # Load environment variables and configuration
 load_dotenv()
 
-try:
-    with open('COUNTRY_MAP.json', 'r', encoding='utf-8') as f:
-        COUNTRY_MAP = json.load(f)
-    logger.info("Successfully loaded country map")
-except Exception as e:
-    logger.error(f"Failed to load country map: {str(e)}")
-    raise SystemExit(1)
-
 # Initialize bot configuration
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -54,85 +62,84 @@ WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "https://homd-deals-bot-jsx7.onrender.c
  # твой Render-домен, например: https://mybot.onrender.com
 WEBHOOK_PATH = "/webhook"
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
+# TTL кэша таблицы geo (секунды); /add, /change, /delete сбрасывают его сразу.
+# 0 — без кэша: одна выборка из geo на сообщение
+geo_routing.ttl = float(os.getenv("GEO_CACHE_TTL", geo_routing.ttl))
+# Куда складывать не записанные в messages строки, пока Supabase недоступен.
+# Пустое значение — такие строки просто отбрасываются
+messages_writer.spill_path = os.getenv("MESSAGES_SPILL_PATH", "messages_spill.jsonl") or None
+# 1 — заметка для партнёра и контакты по GEO одним сообщением
+handlers.MERGE_GEO_REPLIES = os.getenv("GEO_REPLY_MERGE", "0") == "1"
+# Сколько места на диске могут занимать готовые выгрузки (МБ)
+export_cache.max_bytes = int(os.getenv("EXPORT_CACHE_MAX_MB", 200)) * 1024 * 1024
+# Скомпилированная карта стран; пересобирается сама, если COUNTRY_MAP.json изменился
+GEO_ARTIFACT_PATH = os.getenv("GEO_ARTIFACT_PATH", "COUNTRY_MAP.geoidx")
+# Сколько разных слов кэширует разбор GEO (0 — без кэша)
+GEO_MATCH_CACHE_SIZE = int(os.getenv("GEO_MATCH_CACHE_SIZE", 10000))
+
+
+def load_geo_index(path: str = "COUNTRY_MAP.json") -> GeoIndex:
+    """Load the GEO alias index from its compiled artifact, rebuilding it if stale"""
+    try:
+        geo_index = load_geo_artifact(path, GEO_ARTIFACT_PATH, GEO_MATCH_CACHE_SIZE)
+        logger.info("Successfully loaded country map")
+        return geo_index
+    except Exception as e:
+        logger.error(f"Failed to load country map: {str(e)}")
+        raise SystemExit(1)
 
-if not all([SUPABASE_URL, SUPABASE_KEY, TELEGRAM_TOKEN, WEBHOOK_HOST]):
-    logger.error("Missing required environment variables")
-    raise SystemExit(1)
-
-# Initialize Supabase
-try:
-    supabase = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
-    logger.info("Successfully connected to Supabase")
-except Exception as e:
-    logger.error(f"Failed to connect to Supabase: {str(e)}")
-    raise SystemExit(1)
-"""
-# Callback для кнопки "Скачать все"
-async def download_all_callback(callback: types.CallbackQuery, supabase):
-    user_id = callback.from_user.id
-    if not await is_admin(user_id):
-        await callback.answer("❌ У вас нет прав для этой команды.", show_alert=True)
-        return
-
-    # Передаём текст напрямую и бот
-    await send_team_excel_from_callback(callback, supabase)
-
-    await callback.answer()  # убрать "часики"
-
-
-# новая версия send_team_excel для callback
-async def send_team_excel_from_callback(callback: types.CallbackQuery, supabase):
-  
-    Скачивание всех таблиц по кнопке "Скачать все"
- 
-
-    TEAMS = ["Team1", "Team2", "Team3", "Team4", "Team5", "Team6", "Team7"]
-    user_id = callback.from_user.id
-
-    tables = [f"{team.lower()}_requests" for team in TEAMS]
-
-    for table_name in tables:
-        try:
-            response = supabase.table(table_name)\
-                .select("*")\
-                .order("request_date", desc=True)\
-                .execute()
-
-            if not response.data:
-                await callback.message.answer(f"📊 В таблице {table_name} нет данных.")
-                continue
-
-            # DataFrame → Excel
-            import pandas as pd
-            from io import BytesIO
-            df = pd.DataFrame(response.data)
-            for col in df.columns:
-                df[col] = df[col].astype(str)
-
-            buffer = BytesIO()
-            df.to_excel(buffer, index=False, engine="openpyxl")
-            buffer.seek(0)
-
-            from aiogram.types import BufferedInputFile
-            file = BufferedInputFile(buffer.getvalue(), filename=f"{table_name}.xlsx")
 
-            await callback.message.answer_document(
-                document=file,
-                caption=f"📊 Данные из {table_name}"
-            )
-        except Exception as e:
-            logging.error(f"Ошибка при экспорте {table_name}: {e}")
-            await callback.message.answer(f"❌ Ошибка при экспорте {table_name}")
-"""
+def create_repository() -> Repository:
+    """Connect to Supabase; all queries then go through Repository's thread pool"""
+    # supabase тянет httpx/postgrest — импортируем только при подключении
+    from supabase import create_client
 
-async def message_handler(message: types.Message, state: FSMContext):
+    try:
+        supabase = create_client(supabase_url=SUPABASE_URL, supabase_key=SUPABASE_KEY)
+        # все запросы к Supabase идут через пул потоков, а не из event loop
+        repo = Repository(
+            supabase,
+            max_workers=int(os.getenv("DB_MAX_WORKERS", 8)),
+            timeout=float(os.getenv("DB_TIMEOUT", 10))
+        )
+        logger.info("Successfully connected to Supabase")
+        return repo
+    except Exception as e:
+        logger.error(f"Failed to connect to Supabase: {str(e)}")
+        raise SystemExit(1)
+
+
+def build_fsm_storage(repo: Repository):
+    """
+    FSM storage from FSM_STORAGE:
+      memory   — в памяти процесса (по умолчанию), теряется при рестарте
+      sqlite   — локальный файл FSM_SQLITE_PATH, один инстанс
+      supabase — таблица fsm_states, общая для всех реплик
+    """
+    kind = os.getenv("FSM_STORAGE", "memory").lower()
+    if kind == "memory":
+        return MemoryStorage()
+    if kind == "sqlite":
+        backend = SQLiteFSMBackend(os.getenv("FSM_SQLITE_PATH", "fsm.sqlite3"))
+    elif kind == "supabase":
+        backend = SupabaseFSMBackend(repo)
+    else:
+        raise ValueError(f"Unknown FSM_STORAGE: {kind}")
+    logger.info(f"Using {kind} FSM storage")
+    return WriteBehindStorage(
+        backend,
+        flush_interval=float(os.getenv("FSM_FLUSH_INTERVAL", 0.5)),
+        # >0 только когда инстанс один: иначе можно прочитать устаревшее состояние
+        cache_ttl=float(os.getenv("FSM_CACHE_TTL", 0))
+    )
+
+
+async def message_handler(message: types.Message, state: FSMContext, parsed: ParsedMessage, repo: Repository):
     """Route messages to appropriate handlers"""
     try:
-        text = message.text.strip()
-        words = text.replace(",", " ").split()
-        
-        # Try to normalize as GEOs first
-        correct_geos, incorrect_words = normalize_geo(words, COUNTRY_MAP)
+        # GEO уже разобраны в ParseGeoMiddleware
+        words = parsed.words
+        correct_geos = parsed.correct_geos
         current_state = await state.get_state()
         # Route to appropriate handler:
         # 1. If we have correct GEOs, handle as GEO message
@@ -150,8 +157,8 @@ async def message_handler(message: types.Message, state: FSMContext):
                 # если он в сценарии → обычная обработка GEO
                 await handle_geos(
                     message,
-                    supabase,
-                    COUNTRY_MAP
+                    repo,
+                    parsed
                 )
                 await state.clear()
 
@@ -164,11 +171,11 @@ async def message_handler(message: types.Message, state: FSMContext):
         elif len(words) > 3 or not any(len(word) == 2 for word in words):
             # обработка НЕ GEO сообщений
             logger.info(f"Processing other message from user {message.from_user.id}")
-            await handle_other_message(message, supabase)
+            await handle_other_message(message, repo)
 
         else:
             # fallback: если похоже на GEO
-            await handle_geos(message, supabase, COUNTRY_MAP)
+            await handle_geos(message, repo, parsed)
             await state.clear()
 
             # снова кнопка
@@ -181,59 +188,114 @@ async def message_handler(message: types.Message, state: FSMContext):
         logger.error(f"Error in message_handler: {str(e)}")
         await message.reply("❌ An error occurred while processing your message. Please try again later or ping @racketwoman.")
 
-async def geo_handler_wrapper(message: types.Message, state: FSMContext):
-    await geo_handler(message, state, supabase, COUNTRY_MAP)
+async def geo_handler_wrapper(message: types.Message, state: FSMContext, repo: Repository, parsed: ParsedMessage = None):
+    # ParseGeoMiddleware разбирает только текст: стикер или фото — просим GEO текстом
+    if parsed is None:
+        await message.answer("✍️ Please type your GEOs as text (e.g. AU, US, IT):")
+        return
+    await geo_handler(message, state, repo, parsed)
 
-async def download_handler(message: types.Message):
-    """Wrapper function for handle_download to properly pass supabase"""
-    await handle_download(message, supabase)
+async def download_handler(message: types.Message, repo: Repository):
+    """Wrapper function for handle_download to properly pass repo"""
+    await handle_download(message, repo)
 
-async def messages_handler(message: types.Message):
-    """Wrapper function for handle_messages_download to properly pass supabase"""
-    await handle_messages_download(message, supabase)
+async def messages_handler(message: types.Message, repo: Repository):
+    """Wrapper function for handle_messages_download to properly pass repo"""
+    await handle_messages_download(message, repo)
 
-async def change_handler(message: types.Message):
+async def change_handler(message: types.Message, repo: Repository):
     logger.info(f"Received message: {message.text} from {message.from_user.id}")
     """Wrapper function for change_contact command"""
-    await change_contact(message, supabase)
+    await change_contact(message, repo)
 
-async def add_handler(message: types.Message):
+async def add_handler(message: types.Message, repo: Repository):
     """Wrapper function for add_contact command"""
-    await add_contact(message, supabase)
+    await add_contact(message, repo)
 
-async def delete_handler(message: types.Message):
+async def delete_handler(message: types.Message, repo: Repository):
     """Wrapper function for delete_contact command"""
-    await delete_contact(message, supabase)
+    await delete_contact(message, repo)
 
-async def download_all_callback(callback: types.CallbackQuery):
+async def download_all_callback(callback: types.CallbackQuery, repo: Repository):
     logger.info(f"Callback received: {callback.data} from {callback.from_user.id}")
     if not await is_admin(callback.from_user.id):
         await callback.answer("❌ У вас нет прав для этой команды.", show_alert=True)
         return
-    from handlers.excel import send_team_excel
-    await send_team_excel(callback.message, supabase)
-    await callback.answer()
-
-async def on_startup(bot: Bot):
-    await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=True)
-    logger.info(f"Webhook set to {WEBHOOK_URL}")
-
-async def on_shutdown(bot: Bot):
-    await bot.delete_webhook()
-    logger.info("Webhook deleted")
-
-
-def setup_routes(app: web.Application, dp: Dispatcher, bot: Bot):
+    await callback.answer()  # убрать "часики", выгрузка может занять время
+    await send_all_tables(callback.message, repo)
+
+async def on_startup(bot: Bot, pool: UpdateWorkerPool, webhook_url: str):
+    repo = pool.dp["repo"]
+    export_cache.open()
+    request_writer.start(repo)
+    messages_writer.start(repo)
+    pool.start()
+    await bot.set_webhook(webhook_url, drop_pending_updates=True)
+    logger.info(f"Webhook set to {webhook_url}")
+
+async def on_shutdown(pool: UpdateWorkerPool):
+    # вебхук не удаляем: при деплое новый инстанс к этому моменту уже мог его поставить
+    try:
+        await pool.close()
+        # после воркеров: дописываем отложенные изменения FSM
+        await pool.dp.storage.close()
+    finally:
+        # очереди логов дописываем, даже если FSM не удалось сохранить
+        await request_writer.close()
+        await messages_writer.close()
+        export_cache.close()
+        pool.dp["repo"].close()
+
+
+def build_rate_limits():
+    """
+    Лимиты из RATE_LIMIT_<ИМЯ> (на пользователя) и RATE_LIMIT_<ИМЯ>_GLOBAL
+    в виде "токенов_в_секунду:запас", например RATE_LIMIT_GEO=0.2:5
+    """
+    limits = {}
+    for name, (user_limit, global_limit) in DEFAULT_LIMITS.items():
+        user_value = os.getenv(f"RATE_LIMIT_{name.upper()}")
+        global_value = os.getenv(f"RATE_LIMIT_{name.upper()}_GLOBAL")
+        limits[name] = (
+            RateLimit.parse(user_value) if user_value else user_limit,
+            RateLimit.parse(global_value) if global_value else global_limit
+        )
+    return limits
+
+
+def is_export_update(update: dict) -> bool:
+    """Exports run outside the per-chat order: they are slow and nothing in the chat waits for them"""
+    text = (update.get("message") or {}).get("text") or ""
+    command = text.split(maxsplit=1)[0].split("@")[0] if text.startswith("/") else ""
+    data = (update.get("callback_query") or {}).get("data")
+    return command in ("/download", "/messages") or data == "download_all"
+
+
+def setup_routes(app: web.Application, pool: UpdateWorkerPool, throttling: ThrottlingMiddleware, scheduler: SendScheduler):
     async def handle(request: web.Request):
         return web.Response(text="Bot is running")
 
+    async def stats_handler(request: web.Request):
+        return web.json_response({
+            **pool.stats(),
+            "rate_limits": throttling.stats(),
+            "sending": scheduler.stats()
+        })
+
     async def webhook_handler(request: web.Request):
         update = await request.json()
         logger.info(f"Webhook update received: {update}")  # логируем всё
-        await dp.feed_webhook_update(bot, update)
+        # отвечаем Telegram сразу, апдейт обработают воркеры
+        if not pool.submit(update):
+            return web.Response(status=503, text="Busy")
         return web.Response(text="OK")
 
+    async def metrics_handler(request: web.Request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
     app.router.add_get("/", handle)
+    app.router.add_get("/stats", stats_handler)
+    app.router.add_get("/metrics", metrics_handler)
     app.router.add_post(WEBHOOK_PATH, webhook_handler)
 
 async def start_new_request_callback(callback: types.CallbackQuery, state: FSMContext):
@@ -243,42 +305,115 @@ async def start_new_request_callback(callback: types.CallbackQuery, state: FSMCo
 
 
 
-async def main():
-    bot = Bot(token=TELEGRAM_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+def build_dispatcher(repo: Repository, geo_index: GeoIndex, storage=None) -> Dispatcher:
+    """Dispatcher with all middlewares and handlers; handlers get `repo` from its data"""
+    dp = Dispatcher(storage=storage or build_fsm_storage(repo))
+    dp["repo"] = repo
+    dp["geo_index"] = geo_index
+    # Лимиты на пользователя и общие для хендлеров с флагом rate_limit;
+    # стоит до разбора GEO, чтобы отброшенные сообщения не разбирались
+    throttling = ThrottlingMiddleware(build_rate_limits(), max_users=int(os.getenv("RATE_LIMIT_MAX_USERS", 10000)))
+    dp["throttling"] = throttling
+    dp.message.middleware(throttling)
+    dp.callback_query.middleware(throttling)
+    # время хендлеров (вместе с разбором GEO) и их ошибки для /metrics
+    dp.message.middleware(HandlerTimingMiddleware())
+    dp.callback_query.middleware(HandlerTimingMiddleware())
+    # Разбор GEO один раз на апдейт для хендлеров с флагом parse_geo
+    dp.message.middleware(ParseGeoMiddleware(geo_index))
 
     # Регистрация всех обработчиков
     # FSM flow
     dp.message.register(cmd_start, Command("start"))
     dp.message.register(website_handler, StartFlow.waiting_for_website)
     dp.message.register(brand_handler, StartFlow.waiting_for_brand)
-    dp.message.register(geo_handler_wrapper, StartFlow.waiting_for_geo)
+    dp.message.register(geo_handler_wrapper, StartFlow.waiting_for_geo, flags={"parse_geo": True, "rate_limit": "geo"})
     
-    dp.message.register(download_handler, Command("download"))
-    dp.message.register(messages_handler, Command("messages"))
-    dp.message.register(message_handler, lambda message: message.text and not message.text.startswith('/'))
+    dp.message.register(download_handler, Command("download"), flags={"rate_limit": "export"})
+    dp.message.register(messages_handler, Command("messages"), flags={"rate_limit": "export"})
+    dp.message.register(message_handler, lambda message: message.text and not message.text.startswith('/'), flags={"parse_geo": True, "rate_limit": "other"})
     dp.message.register(change_handler, Command("change"))
     dp.message.register(add_handler, Command("add"))
     dp.message.register(delete_handler, Command("delete"))
-    dp.callback_query.register(download_all_callback, lambda c: c.data == "download_all")
+    dp.callback_query.register(download_all_callback, lambda c: c.data == "download_all", flags={"rate_limit": "export"})
     dp.callback_query.register(start_new_request_callback, lambda c: c.data == "start_new_request")
 
     #dp.callback_query.register(geo_button, F.data == "geo")
+    return dp
+
+
+def create_app(bot: Bot, dp: Dispatcher, webhook_url: str = WEBHOOK_URL) -> web.Application:
+    """aiohttp app serving the webhook, /stats and /metrics for a built dispatcher"""
+    # все исходящие сообщения идут через очередь с лимитами Telegram
+    send_limit = os.getenv("SEND_GLOBAL_LIMIT")
+    chat_limit = os.getenv("SEND_CHAT_LIMIT")
+    scheduler = SendScheduler(
+        global_limit=RateLimit.parse(send_limit) if send_limit else GLOBAL_LIMIT,
+        private_limit=RateLimit.parse(chat_limit) if chat_limit else PRIVATE_CHAT_LIMIT
+    )
+    bot.session.middleware(scheduler)
+    # после планировщика: меряем сам запрос к API, без ожидания очереди
+    bot.session.middleware(RequestTimingMiddleware())
+
+    pool = UpdateWorkerPool(
+        dp,
+        bot,
+        workers=int(os.getenv("UPDATE_WORKERS", DEFAULT_WORKERS)),
+        queue_size=int(os.getenv("UPDATE_QUEUE_SIZE", 1000)),
+        # окно update_id для отбрасывания повторных доставок от Telegram
+        dedupe=UpdateDeduplicator(size=int(os.getenv("UPDATE_DEDUPE_SIZE", 10000))),
+        detached=is_export_update
+    )
+    throttling = dp["throttling"]
+
+    metrics.register_stats("bot_update_pool", pool.stats)
+    metrics.register_stats("bot_request_writer", request_writer.stats)
+    metrics.register_stats("bot_messages_writer", messages_writer.stats)
+    metrics.register_stats("bot_export_cache", export_cache.stats)
+    metrics.register_stats("bot_rate_limit", throttling.stats, label="limit")
+    metrics.register_stats("bot_send_scheduler", scheduler.stats)
+    metrics.register_stats("bot_geo_match_cache", dp["geo_index"].stats)
+    if isinstance(dp.storage, WriteBehindStorage):
+        metrics.register_stats("bot_fsm_storage", dp.storage.stats)
 
     app = web.Application()
-    setup_routes(app, dp, bot)
-    app.on_startup.append(lambda _: on_startup(bot))
-    app.on_shutdown.append(lambda _: on_shutdown(bot))
+    setup_routes(app, pool, throttling, scheduler)
+    app.on_startup.append(lambda _: on_startup(bot, pool, webhook_url))
+    app.on_shutdown.append(lambda _: on_shutdown(pool))
+    return app
 
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", int(os.environ.get("PORT", 8000)))
-    await site.start()
-    logger.info("Bot is running...")
 
-    # держим цикл живым
-    while True:
-        await asyncio.sleep(3600)
+async def main():
+    if not all([SUPABASE_URL, SUPABASE_KEY, TELEGRAM_TOKEN, WEBHOOK_HOST]):
+        logger.error("Missing required environment variables")
+        raise SystemExit(1)
+
+    # всё тяжёлое — здесь, а не при импорте модуля
+    repo = create_repository()
+    geo_index = load_geo_index()
+    bot = Bot(token=TELEGRAM_TOKEN)
+    dp = build_dispatcher(repo, geo_index)
+    app = create_app(bot, dp)
+
+    # SIGTERM при деплое/рестарте: останавливаемся через runner.cleanup(),
+    # иначе on_shutdown не вызовется и принятые апдейты и очереди пропадут
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(app)
+    try:
+        await runner.setup()
+        site = web.TCPSite(runner, "0.0.0.0", int(os.environ.get("PORT", 8000)))
+        await site.start()
+        logger.info("Bot is running...")
+        await stop.wait()
+        logger.info("Stopping, finishing accepted updates...")
+    finally:
+        # сначала закрывает приём запросов, потом вызывает on_shutdown
+        await runner.cleanup()
+        await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())  # <-- запускаем только async main
\ No newline at end of file
+    asyncio.run(main())  # <-- запускаем только async main
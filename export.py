@@ -0,0 +1,621 @@
+"""
+Export engine shared by every admin download.
+
+A TableSource describes what to read (any Supabase table, its ordering
+column and optional filters); EXPORT_FORMATS maps a format name to the sink
+that writes rows into a file. Rows are paged out of Supabase and streamed
+into the sink in a worker thread, finished files are cached on disk by the
+table's high-water mark and re-sent by Telegram file_id while unchanged.
+"""
+import asyncio
+import csv
+import gzip
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+import zipfile
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Tuple
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк забираем из Supabase за один запрос при экспорте
+EXPORT_PAGE_SIZE = 1000
+# Сколько таблиц выгружаем одновременно (на все запросы админов вместе)
+EXPORT_WORKERS = 3
+# Строк в одной группе при записи parquet
+PARQUET_CHUNK_SIZE = 10000
+# Каталог кэша выгрузок: <prefix><pid>_<случайный суффикс>, у каждого процесса свой
+CACHE_DIR_PREFIX = "homd_export_cache_"
+
+
+# --- sources ---
+
+@dataclass(frozen=True)
+class TableSource:
+    """
+    A Supabase table read newest-first by `order_column`, optionally
+    filtered; `tiebreak_column` (the primary key) orders rows that share
+    an order_column value
+    """
+    table: str
+    order_column: str
+    filters: Tuple[Tuple[str, str, str], ...] = ()  # (column, operator, value)
+    tiebreak_column: str = "id"
+
+    @property
+    def name(self) -> str:
+        return self.table
+
+    def select(self, client, columns: str = "*", count=None):
+        query = client.table(self.table).select(columns, count=count)
+        for column, operator, value in self.filters:
+            query = query.filter(column, operator, value)
+        # order() подставляет колонку в параметр как есть:
+        # получается один order=<order_column>.desc,<tiebreak_column>.desc
+        return query.order(f"{self.order_column}.desc,{self.tiebreak_column}", desc=True)
+
+    def iter_rows(self, fetch, since=None, page_size: int = EXPORT_PAGE_SIZE):
+        """
+        Yield all rows, newest first, one page at a time.
+        With `since` only rows with tiebreak_column > since are returned:
+        the id is assigned by the database on insert, so rows that arrive
+        late (batch windows, retries, the spill file) still come after it,
+        which a client-side timestamp can't promise.
+
+        Keyset pagination on (order_column, tiebreak_column), which together
+        are unique: after a page that ended at (value, id) the next one takes
+        the rows tied on value with a smaller id, then the rows older than
+        value. No row is repeated or skipped, whatever order Postgres would
+        give tied rows. `fetch(build_query)` returns the rows of one page
+        (see repository_fetch). Synchronous — run it in a worker thread.
+        """
+        order_column, tiebreak_column = self.order_column, self.tiebreak_column
+        cursor = None
+
+        while True:
+            rows = []
+            if cursor is not None:
+                value, last_id = cursor
+                # хвост строк с тем же значением, на котором закончилась страница
+                rows = self._page(fetch, since, page_size, lambda q: q.eq(order_column, value).lt(tiebreak_column, last_id))
+            if len(rows) < page_size:
+                older = (lambda q: q.lt(order_column, cursor[0])) if cursor is not None else (lambda q: q)
+                rows += self._page(fetch, since, page_size - len(rows), older)
+
+            yield from rows
+            if len(rows) < page_size:
+                return
+            cursor = (rows[-1][order_column], rows[-1][tiebreak_column])
+
+    def _page(self, fetch, since, limit: int, narrow):
+        def build_query(client):
+            query = self.select(client)
+            if since is not None:
+                query = query.gt(self.tiebreak_column, since)
+            return narrow(query).limit(limit)
+
+        return fetch(build_query)
+
+    async def high_water_mark(self, repo):
+        """(newest order_column value, row count); (None, 0) when empty"""
+        response = await repo.execute(lambda c: self.select(c, self.order_column, count="exact").limit(1))
+        newest = response.data[0][self.order_column] if response.data else None
+        return newest, response.count or 0
+
+    async def since_id(self, repo, watermark):
+        """
+        Id to export after, from a stored watermark: the last exported id,
+        or (saved before ids were used) an order_column value, which maps
+        to the id just before the first newer row so nothing is skipped
+        """
+        if watermark is None or str(watermark).isdigit():
+            return None if watermark is None else int(watermark)
+
+        def first_id(newer: bool):
+            def build_query(client):
+                query = client.table(self.table).select(self.tiebreak_column)
+                for column, operator, value in self.filters:
+                    query = query.filter(column, operator, value)
+                if newer:
+                    return query.gt(self.order_column, watermark).order(self.tiebreak_column).limit(1)
+                return query.order(self.tiebreak_column, desc=True).limit(1)
+            return build_query
+
+        rows = await repo.run(first_id(newer=True))
+        if rows:
+            return rows[0][self.tiebreak_column] - 1
+        # новее ничего нет — продолжаем после последней строки
+        rows = await repo.run(first_id(newer=False))
+        return rows[0][self.tiebreak_column] if rows else None
+
+
+# --- sinks ---
+
+def write_xlsx(rows, path: str) -> int:
+    """Stream rows into a write-only workbook, returns the number of rows written"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    columns = None
+    count = 0
+
+    for row in rows:
+        if columns is None:
+            columns = list(row)
+            sheet.append(columns)
+        # все значения как строки, как раньше делал astype(str)
+        sheet.append([str(row.get(column)) for column in columns])
+        count += 1
+
+    if count:
+        workbook.save(path)
+    return count
+
+
+def _write_csv_stream(rows, f) -> int:
+    writer = csv.writer(f)
+    columns = None
+    count = 0
+
+    for row in rows:
+        if columns is None:
+            columns = list(row)
+            writer.writerow(columns)
+        writer.writerow([row.get(column) for column in columns])
+        count += 1
+    return count
+
+
+def write_csv(rows, path: str) -> int:
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        return _write_csv_stream(rows, f)
+
+
+def write_csv_gz(rows, path: str) -> int:
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=6) as f:
+        return _write_csv_stream(rows, f)
+
+
+def write_parquet(rows, path: str) -> int:
+    """Write rows as string columns in row groups of PARQUET_CHUNK_SIZE; needs pyarrow"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    columns = None
+    count = 0
+    chunk = []
+
+    def flush():
+        data = {column: [None if row.get(column) is None else str(row.get(column)) for row in chunk] for column in columns}
+        writer.write_table(pa.table(data, schema=schema))
+        chunk.clear()
+
+    try:
+        for row in rows:
+            if columns is None:
+                columns = list(row)
+                schema = pa.schema([(column, pa.string()) for column in columns])
+                writer = pq.ParquetWriter(path, schema)
+            chunk.append(row)
+            count += 1
+            if len(chunk) >= PARQUET_CHUNK_SIZE:
+                flush()
+        if chunk:
+            flush()
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+# формат -> функция записи; имя файла: <источник>.<формат>
+EXPORT_FORMATS = {
+    "xlsx": write_xlsx,
+    "csv": write_csv,
+    "csv.gz": write_csv_gz,
+    "parquet": write_parquet
+}
+
+
+def format_available(fmt: str) -> bool:
+    """parquet needs the optional pyarrow package"""
+    if fmt == "parquet":
+        return importlib.util.find_spec("pyarrow") is not None
+    return True
+
+
+# --- command arguments ---
+
+def parse_format(args, default: str = "xlsx"):
+    """Pull an export format out of command arguments: returns (format, other args)"""
+    fmt = default
+    rest = []
+    for arg in args:
+        if arg.lower() in EXPORT_FORMATS:
+            fmt = arg.lower()
+        else:
+            rest.append(arg)
+    return fmt, rest
+
+
+def parse_since(args):
+    """Pull the --since flag out of command arguments: returns (since, other args)"""
+    rest = [arg for arg in args if arg.lower() != "--since"]
+    return len(rest) < len(args), rest
+
+
+# --- rendering ---
+
+def repository_fetch(repo, loop: asyncio.AbstractEventLoop):
+    """
+    Page fetcher for export_to_file running in a worker thread: every page
+    goes through repo.run on the event loop, so it shares the repository's
+    thread pool and concurrency cap and fails after its timeout instead of
+    holding an export slot forever.
+    """
+    def fetch(build_query):
+        return asyncio.run_coroutine_threadsafe(repo.run(build_query), loop).result()
+    return fetch
+
+
+def export_to_file(fetch, source: TableSource, fmt: str = "xlsx", since=None):
+    """
+    Export a source (or only rows with an id above `since`) to a temporary
+    file; pages are read with `fetch` (see repository_fetch).
+    Returns (path, rows, largest exported id); path is None when there is
+    nothing to export.
+    """
+    last_id = [None]
+
+    def track_last_id(rows):
+        # строки идут по дате, а не по id — максимум ищем по всем
+        for row in rows:
+            row_id = row[source.tiebreak_column]
+            if last_id[0] is None or row_id > last_id[0]:
+                last_id[0] = row_id
+            yield row
+
+    fd, path = tempfile.mkstemp(prefix=f"{source.name}_", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = EXPORT_FORMATS[fmt](track_last_id(source.iter_rows(fetch, since)), path)
+    except Exception:
+        os.remove(path)
+        raise
+
+    if not count:
+        os.remove(path)
+        return None, 0, None
+    return path, count, last_id[0]
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@dataclass
+class CachedExport:
+    path: str
+    rows: int
+    size: int
+    file_id: str = None  # Telegram file_id после первой отправки
+    users: int = 0  # сколько выгрузок сейчас используют файл
+    evicted: bool = False  # вытеснен из кэша, удалить после последнего пользователя
+
+
+class ExportCache:
+    """
+    Rendered exports on local disk, keyed by (source, format, newest date, row count).
+
+    While a table has not changed, repeated exports reuse the file and, once
+    it has been sent, its Telegram file_id, so nothing is rendered or
+    uploaded again. Files are evicted least-recently-used first when the
+    total size goes over `max_bytes`. Entries handed out with acquire()
+    keep their file on disk until the matching release(), even if they are
+    evicted in between.
+    """
+
+    def __init__(self, parent: str = None, max_bytes: int = 200 * 1024 * 1024):
+        self.parent = parent or tempfile.gettempdir()
+        self.directory = None
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> CachedExport, от старых к новым
+        self._locks = {}  # key -> [Lock, сколько запросов его держат или ждут]
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self._opened = False
+
+    def open(self):
+        """
+        Create this process's cache directory. Directories left by processes
+        that are gone (or by an earlier run with our pid) are removed; other
+        live processes on the host keep theirs.
+        """
+        os.makedirs(self.parent, exist_ok=True)
+        for name in os.listdir(self.parent):
+            if not name.startswith(CACHE_DIR_PREFIX):
+                continue
+            pid = name[len(CACHE_DIR_PREFIX):].split("_", 1)[0]
+            # наш pid у чужого каталога — прошлый запуск (например, pid 1 в контейнере)
+            if pid.isdigit() and (int(pid) == os.getpid() or not _process_alive(int(pid))):
+                shutil.rmtree(os.path.join(self.parent, name), ignore_errors=True)
+        self.directory = tempfile.mkdtemp(prefix=f"{CACHE_DIR_PREFIX}{os.getpid()}_", dir=self.parent)
+        self._opened = True
+
+    def close(self):
+        """Remove this process's cache directory"""
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self._entries.clear()
+        self._size = 0
+        self._opened = False
+
+    @asynccontextmanager
+    async def lock(self, key):
+        """Per-key lock so concurrent requests render a table only once"""
+        holder = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        holder[1] += 1
+        try:
+            async with holder[0]:
+                yield
+        finally:
+            holder[1] -= 1
+            # ключ без ожидающих больше не нужен, даже если до put() не дошло
+            if not holder[1]:
+                del self._locks[key]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def acquire(self, entry: CachedExport):
+        entry.users += 1
+
+    def release(self, entry: CachedExport):
+        entry.users -= 1
+        if not entry.users and entry.evicted:
+            self._remove(entry)
+
+    def put(self, key, path: str, rows: int) -> CachedExport:
+        """Move a rendered file into the cache"""
+        if not self._opened:
+            self.open()
+        source, fmt = key[0], key[1]
+        # старые версии того же источника больше не понадобятся
+        for old_key in [k for k in self._entries if k[:2] == (source, fmt)]:
+            self._evict(old_key)
+
+        cached_path = os.path.join(self.directory, f"{source.name}_{uuid.uuid4().hex}.{fmt}")
+        shutil.move(path, cached_path)
+        entry = CachedExport(path=cached_path, rows=rows, size=os.path.getsize(cached_path))
+        self._entries[key] = entry
+        self._size += entry.size
+
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            self._evict(next(iter(self._entries)))
+        return entry
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        entry.evicted = True
+        # файл может ещё ждать отправки или упаковки в zip
+        if not entry.users:
+            self._remove(entry)
+
+    @staticmethod
+    def _remove(entry: CachedExport):
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+export_cache = ExportCache()
+_export_semaphore = asyncio.Semaphore(EXPORT_WORKERS)
+
+
+@dataclass
+class ExportResult:
+    source: TableSource
+    fmt: str
+    path: str = None
+    rows: int = 0
+    last_id: int = None  # для водяного знака --since
+    error: Exception = None
+    cached: CachedExport = None  # файл лежит в export_cache, его отпускает cleanup()
+
+    @property
+    def filename(self) -> str:
+        return f"{self.source.name}.{self.fmt}"
+
+    def cleanup(self):
+        """Release the cached file or delete the temporary one; safe to call twice"""
+        if self.cached is not None:
+            export_cache.release(self.cached)
+            self.cached = None
+        elif self.path:
+            os.remove(self.path)
+        self.path = None
+
+
+async def render(repo, source: TableSource, fmt: str, since_admin: int = None) -> ExportResult:
+    """
+    Render one source into a file; failures are returned in ExportResult.error.
+    With `since_admin` only rows added after that admin's watermark are exported.
+    """
+    fetch = repository_fetch(repo, asyncio.get_running_loop())
+    try:
+        if since_admin is not None:
+            # инкрементальные выгрузки у каждого админа свои, не кэшируем
+            watermark = await repo.get_export_watermark(since_admin, source.table)
+            since = await source.since_id(repo, watermark)
+            async with _export_semaphore:
+                path, count, last_id = await asyncio.to_thread(export_to_file, fetch, source, fmt, since)
+            return ExportResult(source, fmt, path, count, last_id)
+
+        newest, total = await source.high_water_mark(repo)
+        if not total:
+            return ExportResult(source, fmt)
+
+        key = (source, fmt, newest, total)
+        # слот экспорта берём только под саму выгрузку: дубликаты ждут
+        # на блокировке ключа, не занимая слотов
+        async with export_cache.lock(key):
+            entry = export_cache.get(key)
+            if entry is None:
+                async with _export_semaphore:
+                    path, count, _ = await asyncio.to_thread(export_to_file, fetch, source, fmt)
+                if not count:
+                    return ExportResult(source, fmt)
+                entry = export_cache.put(key, path, count)
+            else:
+                logger.info(f"Export cache hit for {source.name}.{fmt}")
+            # не даём удалить файл, пока результат не отпустят через cleanup()
+            export_cache.acquire(entry)
+        return ExportResult(source, fmt, entry.path, entry.rows, cached=entry)
+    except Exception as e:
+        return ExportResult(source, fmt, error=e)
+
+
+async def send_result(message: types.Message, result: ExportResult, caption: str):
+    """Send by cached Telegram file_id when possible, upload the file otherwise"""
+    entry = result.cached
+
+    if entry is not None and entry.file_id:
+        try:
+            await message.reply_document(document=entry.file_id, caption=caption)
+            return
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached file_id for {result.filename} rejected: {e}")
+            entry.file_id = None
+
+    sent = await message.reply_document(
+        document=types.FSInputFile(result.path, filename=result.filename),
+        caption=caption
+    )
+    if entry is not None and sent.document:
+        entry.file_id = sent.document.file_id
+
+
+async def save_watermark(repo, admin_id: int, result: ExportResult):
+    try:
+        await repo.set_export_watermark(admin_id, result.source.table, str(result.last_id))
+    except Exception as e:
+        logger.error(f"Failed to save export watermark for {result.source.table}: {str(e)}")
+
+
+def _bundle_zip(results) -> str:
+    """Pack exported files into one temporary zip archive"""
+    fd, zip_path = tempfile.mkstemp(prefix="export_", suffix=".zip")
+    os.close(fd)
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for result in results:
+            archive.write(result.path, arcname=result.filename)
+    return zip_path
+
+
+async def export_and_send(
+    message: types.Message,
+    repo,
+    sources,
+    fmt: str = "xlsx",
+    bundle: bool = False,
+    since_admin: int = None,
+    archive_name: str = "export.zip"
+):
+    """
+    Render sources concurrently and send each file as soon as it is ready,
+    or all of them in one zip archive when `bundle` is set. With
+    `since_admin` the admin's watermark moves forward once a file is
+    delivered.
+    """
+    tasks = [asyncio.create_task(render(repo, source, fmt, since_admin)) for source in sources]
+    ready = []  # ExportResult для zip
+
+    try:
+        for finished in asyncio.as_completed(tasks):
+            result = await finished
+            name = result.source.name
+
+            if result.error is not None:
+                logger.error(f"Error exporting {name}: {str(result.error)}")
+                await message.reply(f"❌ Ошибка при экспорте {name}")
+                continue
+
+            if not result.rows:
+                if since_admin is not None:
+                    await message.reply(f"📊 В таблице {name} нет новых строк с прошлой выгрузки.")
+                else:
+                    await message.reply(f"📊 В таблице {name} нет данных.")
+                continue
+
+            if bundle:
+                ready.append(result)
+                continue
+
+            try:
+                await send_result(message, result, caption=f"📊 Данные из {name}")
+                logger.info(f"✅ Sent {result.filename} ({result.rows} rows)")
+                if since_admin is not None:
+                    await save_watermark(repo, since_admin, result)
+            except Exception as send_err:
+                logger.error(f"Error sending {name}: {str(send_err)}")
+                await message.reply(f"❌ Ошибка при экспорте {name}")
+            finally:
+                result.cleanup()
+
+        if ready:
+            ready.sort(key=lambda result: sources.index(result.source))
+            zip_path = await asyncio.to_thread(_bundle_zip, ready)
+            try:
+                await message.reply_document(
+                    document=types.FSInputFile(zip_path, filename=archive_name),
+                    caption=f"📊 Данные из {len(ready)} таблиц"
+                )
+            finally:
+                os.remove(zip_path)
+            if since_admin is not None:
+                for result in ready:
+                    await save_watermark(repo, since_admin, result)
+    finally:
+        for result in ready:
+            result.cleanup()
+        # если цикл прервался, готовые результаты тоже надо отпустить
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.result().cleanup()
@@ -1,21 +1,61 @@
-from io import BytesIO
-import pandas as pd
 import logging
 from aiogram import types
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from admin import is_admin  # твоя проверка админов
+from export import TableSource, export_and_send, format_available, parse_format, parse_since
 
 logger = logging.getLogger(__name__)
 
 # список всех команд (их имена совпадают с team_name в geo)
 TEAMS = ["Team1", "Team2", "Team3", "Team4", "Team5", "Team6", "Team7", "Team8"]
 
-async def send_team_excel(message: types.Message, supabase):
+
+def team_source(team: str) -> TableSource:
+    """Requests table of a team, newest request first"""
+    return TableSource(f"{team.lower()}_requests", "request_date")
+
+
+async def export_tables(
+    message: types.Message,
+    repo,
+    sources,
+    fmt: str = "xlsx",
+    bundle: bool = False,
+    since_admin: int = None
+):
+    """Export team request tables; a bundle is sent as requests.zip"""
+    await export_and_send(
+        message,
+        repo,
+        sources,
+        fmt=fmt,
+        bundle=bundle,
+        since_admin=since_admin,
+        archive_name="requests.zip"
+    )
+
+
+async def send_all_tables(message: types.Message, repo, fmt: str = "xlsx", bundle: bool = False, since_admin: int = None):
+    """Export every team table; used by /download all and the download_all button"""
+    await export_tables(
+        message,
+        repo,
+        [team_source(team) for team in TEAMS],
+        fmt=fmt,
+        bundle=bundle,
+        since_admin=since_admin
+    )
+
+
+async def send_team_excel(message: types.Message, repo):
     """
     Admin-only command to download request tables.
     Usage:
       /download Team1 Team2 ...
       /download all
+      /download all zip — все таблицы одним архивом
+      /download Team1 csv — формат: xlsx (по умолчанию), csv, csv.gz, parquet
+      /download Team3 --since — только строки новее вашей прошлой выгрузки
     """
     try:
         user_id = message.from_user.id
@@ -31,58 +71,35 @@ async def send_team_excel(message: types.Message, supabase):
             await message.reply(
                 "⚠️ Использование команды:\n"
                 "`/download Team1 Team2 ...`\n"
-                "или `/download all` чтобы скачать все таблицы.",
+                "или `/download all` чтобы скачать все таблицы.\n"
+                "Добавьте `zip`, чтобы получить всё одним архивом, "
+                "и `csv`, `csv.gz` или `parquet`, чтобы сменить формат.\n"
+                "`--since` — только новые строки с вашей прошлой выгрузки.",
                 parse_mode="Markdown",
                 reply_markup=kb.as_markup()
             )
             return
 
-        targets = parts[1:]
-        tables = []
+        since, args = parse_since(parts[1:])
+        since_admin = user_id if since else None
+        fmt, args = parse_format(args)
+        if not format_available(fmt):
+            await message.reply(f"⚠️ Формат {fmt} недоступен на сервере.")
+            return
+        targets = [t for t in args if t.lower() != "zip"]
+        bundle = len(targets) < len(args)
 
         if "all" in [t.lower() for t in targets]:
-            tables = [f"{team.lower()}_requests" for team in TEAMS]
-        else:
-            tables = [f"{team.lower()}_requests" for team in targets if team in TEAMS]
+            await send_all_tables(message, repo, fmt=fmt, bundle=bundle, since_admin=since_admin)
+            return
+
+        sources = [team_source(team) for team in targets if team in TEAMS]
 
-        if not tables:
+        if not sources:
             await message.reply("⚠️ Таблицы не найдены. Проверьте названия команд.")
             return
 
-        for table_name in tables:
-            try:
-                response = supabase.table(table_name)\
-                    .select("*")\
-                    .order("request_date", desc=True)\
-                    .execute()
-                
-                if not response.data:
-                    await message.reply(f"📊 В таблице {table_name} нет данных.")
-                    continue
-
-                # DataFrame → Excel
-                df = pd.DataFrame(response.data)
-                for col in df.columns:
-                    df[col] = df[col].astype(str)
-
-                buffer = BytesIO()
-                df.to_excel(buffer, index=False, engine="openpyxl")
-                buffer.seek(0)
-
-                file = types.BufferedInputFile(
-                    buffer.getvalue(),
-                    filename=f"{table_name}.xlsx"
-                )
-
-                await message.reply_document(
-                    document=file,
-                    caption=f"📊 Данные из {table_name}"
-                )
-                logger.info(f"✅ Sent {table_name} to admin {user_id}")
-
-            except Exception as table_err:
-                logger.error(f"Error exporting {table_name}: {str(table_err)}")
-                await message.reply(f"❌ Ошибка при экспорте {table_name}")
+        await export_tables(message, repo, sources, fmt=fmt, bundle=bundle, since_admin=since_admin)
 
     except Exception as e:
         logger.error(f"Error in send_team_excel: {str(e)}")
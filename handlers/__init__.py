@@ -1,15 +1,26 @@
 import logging
 from datetime import datetime
-from itertools import combinations
-from rapidfuzz import process, fuzz
 
 from aiogram import types
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
+from handlers.geo_index import GeoIndex, normalize_geo
+from handlers.parsing import MAX_GEOS_PER_REQUEST, ParsedMessage, ParseGeoMiddleware, parse_message
+from handlers.routing import GeoRoutingCache, geo_routing, group_geos_by_team
+from handlers.throttling import DEFAULT_LIMITS, RateLimit, ThrottlingMiddleware, TokenBuckets
+from metrics import stage_seconds
+from writers import request_writer
+
 logger = logging.getLogger(__name__)
 
+# Склеивать ли заметку для партнёра с контактами (3 ответа вместо 4);
+# выставляется из GEO_REPLY_MERGE в bot.py
+MERGE_GEO_REPLIES = False
+# Ограничение Telegram на длину одного сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 # --- Определяем шаги сценария ---
 class StartFlow(StatesGroup):
     waiting_for_website = State()
@@ -47,13 +58,13 @@ async def brand_handler(message: types.Message, state: FSMContext):
     await message.answer("👍 Great! Now type your GEOs (e.g. AU, US, IT):")
 
 # --- Пользователь вводит GEO ---
-async def geo_handler(message: types.Message, state: FSMContext, supabase, COUNTRY_MAP):
+async def geo_handler(message: types.Message, state: FSMContext, repo, parsed: ParsedMessage):
     data = await state.get_data()
     website = data.get("website", "[URL]")
     brand = data.get("brand", "[Brand]")
 
    # Запускаем geo-логику
-    await handle_geos(message, supabase, COUNTRY_MAP, website=website, brand=brand)
+    await handle_geos(message, repo, parsed, website=website, brand=brand)
 
     # После обработки очищаем state
     await state.clear()
@@ -62,17 +73,19 @@ async def geo_button(callback_query: types.CallbackQuery):
     await callback_query.answer()
     await callback_query.message.answer("✍️ Please enter GEOs (e.g. AU, US, IT):")
 """
-async def log_user_request(supabase, user_id, username, geo_list, website="[URL]", brand="[Brand]"):
+async def log_user_request(repo, user_id, username, parsed: ParsedMessage, website="[URL]", brand="[Brand]", geo_rows=None):
     try:
         now = datetime.utcnow().isoformat()
+        geo_list = parsed.correct_geos
         if not geo_list:
             return
 
+        if geo_rows is None:
+            geo_rows = await geo_routing.resolve(repo, geo_list)
+
         team_map = {}  # team_name -> list of GEOs
         for geo in geo_list:
-            pg_array = "{" + geo + "}"
-            response = supabase.table("geo").select("*").filter("geos", "cs", pg_array).execute()
-            for row in response.data:
+            for row in geo_rows[geo]:
                 # team_table = f"{row['team_name'].lower()}_requests"
                 team_name = row['team_name'].lower()
                 if team_name not in team_map:
@@ -81,84 +94,63 @@ async def log_user_request(supabase, user_id, username, geo_list, website="[URL]
         for team_name, geos in team_map.items():
             team_table = f"{team_name}_requests"
             geo_text = " ".join(geos)  # объединяем GEO в одну строку
-            supabase.table(team_table).insert({
+            request_writer.submit(team_table, {
                 "user_id": user_id,
                 "username": username,
                 "geo": geo_text,
                 "site": website,
                 "brand": brand,
                 "request_date": now
-            }).execute()
+            })
 
-        supabase.table("team8_requests").insert({
+        # запись уходит в фоновую очередь, ответ пользователю её не ждёт
+        request_writer.submit("team8_requests", {
             "user_id": user_id,
             "username": username,
             "geo": " ".join(geo_list),
             "site": website,
             "brand": brand,
             "request_date": now
-        }).execute()
+        })
             
     except Exception as e:
         logging.error(f"Failed to log request: {str(e)}")
 
 
-def normalize_geo(user_words, COUNTRY_MAP):
-    correct = []
-    incorrect = []
-
-    for word in user_words:
-        word_clean = word.strip().replace("ё", "е").upper()
-        best_match = None
-        best_score = 70
-
-        for geo_code, names in COUNTRY_MAP.items():
-            score = process.extractOne(word_clean, names, scorer=fuzz.ratio)
-            if score and score[1] >= best_score:
-                best_match = geo_code
-                best_score = score[1]
-
-        if best_match:
-            correct.append(best_match)
-        else:
-            incorrect.append(word)
-
-    return correct, incorrect
-
-async def handle_geos(message: types.Message, supabase, COUNTRY_MAP, website="[URL]", brand="[Brand]"):
+async def handle_geos(message: types.Message, repo, parsed: ParsedMessage, website="[URL]", brand="[Brand]"):
     try:
-        text = message.text.strip()
-        user_words = text.replace(",", " ").split()
+        correct_geos = parsed.correct_geos
+        incorrect_words = parsed.incorrect_words
+
+        # GEO -> строки команд из кэша, общий для логирования и ответа
+        with stage_seconds.time(stage="geo_routing"):
+            geo_rows = await geo_routing.resolve(repo, correct_geos)
 
-        correct_geos, incorrect_words = normalize_geo(user_words, COUNTRY_MAP)
         await log_user_request(
-            supabase,
+            repo,
             message.from_user.id,
             message.from_user.username,
-            correct_geos,
+            parsed,
             website=website,
-            brand=brand
+            brand=brand,
+            geo_rows=geo_rows
         )
 
         geo_team_map = {}
         for geo in correct_geos:
-            pg_array = "{" + geo + "}"
-            response = supabase.table("geo").select("*").filter("geos", "cs", pg_array).execute()
-            geo_team_map[geo] = set()
-            for row in response.data:
+            # dict как упорядоченное множество — порядок команд стабилен
+            geo_team_map[geo] = {}
+            for row in geo_rows[geo]:
                 team_contact = f"{row['team_name']} – {row['contact']}"
-                geo_team_map[geo].add(team_contact)
+                geo_team_map[geo][team_contact] = None
 
-        used_teams = set()
-        reply_parts = []
+        reply_parts = group_geos_by_team(correct_geos, geo_team_map)
 
-        for r in range(len(correct_geos), 0, -1):
-            for geo_combo in combinations(correct_geos, r):
-                combo_teams = set.intersection(*(geo_team_map[geo] for geo in geo_combo))
-                combo_teams -= used_teams
-                if combo_teams:
-                    reply_parts.append(f"GEO: {', '.join(geo_combo)} – " + ", ".join(combo_teams))
-                    used_teams.update(combo_teams)
+        if parsed.dropped_geos:
+            reply_parts.append(
+                f"⚠️ Only the first {MAX_GEOS_PER_REQUEST} GEOs were processed, "
+                f"{parsed.dropped_geos} more were skipped"
+            )
 
         for word in incorrect_words:
             reply_parts.append(f"❌ No managers found for {word}")
@@ -181,16 +173,22 @@ async def handle_geos(message: types.Message, supabase, COUNTRY_MAP, website="[U
             )
 
             # 3 сообщение
-            await message.reply(
+            closing_note = (
                 "- If anything looks off or a link doesn’t work, ping @racketwoman.\n"
                 "Great to (e-)meet you — have a fantastic day! 🙌"
             )
-
-            # 4 сообщение – контакты по GEO + сразу кнопка
-            await message.reply(
-                "\n".join(reply_parts),
-                reply_markup=get_start_new_request_keyboard()
-            )
+            merged_text = f"{closing_note}\n\n{reply_text}"
+            if MERGE_GEO_REPLIES and len(merged_text) <= TELEGRAM_MESSAGE_LIMIT:
+                # 3+4 одним сообщением – меньше исходящих в этот чат
+                await message.reply(merged_text, reply_markup=get_start_new_request_keyboard())
+            else:
+                await message.reply(closing_note)
+
+                # 4 сообщение – контакты по GEO + сразу кнопка
+                await message.reply(
+                    reply_text,
+                    reply_markup=get_start_new_request_keyboard()
+                )
 
         logger.info(f"GEO processed for {message.from_user.id}: {correct_geos}")
 
@@ -207,6 +205,17 @@ __all__ = [
     #'geo_button',
     'handle_geos',
     'normalize_geo',
+    'GeoIndex',
+    'ParsedMessage',
+    'ParseGeoMiddleware',
+    'parse_message',
+    'GeoRoutingCache',
+    'geo_routing',
+    'group_geos_by_team',
+    'DEFAULT_LIMITS',
+    'RateLimit',
+    'ThrottlingMiddleware',
+    'TokenBuckets',
     'log_user_request',
     'get_start_new_request_keyboard'
 ]
\ No newline at end of file
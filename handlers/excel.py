@@ -1,29 +1,32 @@
 import logging
-import pandas as pd
 from aiogram import types
 from aiogram.filters import Command
-from aiogram.types import BufferedInputFile
 
+from export import TableSource, format_available, parse_format, parse_since, render, save_watermark, send_result
 from getexcel import send_team_excel
 from admin import is_admin
-from io import BytesIO
 
 logger = logging.getLogger(__name__)
 
-async def handle_download(message: types.Message, supabase):
+MESSAGES_SOURCE = TableSource("messages", "message_date")
+
+async def handle_download(message: types.Message, repo):
     """
     Handle the download command to generate Excel reports
     """
     
     try:
         logger.info(f"Download requested by user {message.from_user.id}")
-        await send_team_excel(message, supabase)
+        await send_team_excel(message, repo)
     except Exception as e:
         logger.error(f"Error handling download: {str(e)}")
         await message.reply("❌ An error occurred while processing your request.")
 
-async def handle_messages_download(message: types.Message, supabase):
-    """Handle the messages command to generate Excel reports for admins"""
+async def handle_messages_download(message: types.Message, repo):
+    """
+    Handle the messages command to generate reports for admins.
+    Usage: /messages [xlsx|csv|csv.gz|parquet] [--since]
+    """
     try:
         user_id = message.from_user.id
         
@@ -32,41 +35,36 @@ async def handle_messages_download(message: types.Message, supabase):
             await message.reply("❌ You are not authorized to use this command.")
             return
 
-        logger.info(f"Messages download requested by admin {user_id}")
-        
-        # Get data from messages table
-        response = supabase.table("messages")\
-            .select("*")\
-            .order("message_date", desc=True)\
-            .execute()
-        
-        if not response.data:
-            await message.reply("📊 No messages found in the database.")
+        since_flag, args = parse_since(message.text.split()[1:])
+        fmt, _ = parse_format(args)
+        if not format_available(fmt):
+            await message.reply(f"⚠️ Format {fmt} is not available on the server.")
             return
 
-        # Create Excel in memory
-        df = pd.DataFrame(response.data)
+        logger.info(f"Messages download ({fmt}) requested by admin {user_id}")
         
-        # Convert all columns to string
-        for column in df.columns:
-            df[column] = df[column].astype(str)
+        # --since: только сообщения новее прошлой выгрузки этого админа
+        since_admin = user_id if since_flag else None
+        result = await render(repo, MESSAGES_SOURCE, fmt, since_admin)
+        if result.error is not None:
+            raise result.error
 
-        buffer = BytesIO()
-        df.to_excel(buffer, index=False, engine='openpyxl')
-        buffer.seek(0)
-        
-        excel_file = BufferedInputFile(
-            buffer.getvalue(),
-            filename="messages.xlsx"
-        )
+        if not result.rows:
+            if since_flag:
+                await message.reply("📊 No new messages since your last export.")
+            else:
+                await message.reply("📊 No messages found in the database.")
+            return
 
-        await message.reply_document(
-            document=excel_file,
-            caption="📊 Messages database export"
-        )
-        logger.info(f"Successfully sent messages Excel file to admin {user_id}")
+        try:
+            await send_result(message, result, caption="📊 Messages database export")
+        finally:
+            result.cleanup()
+        if since_flag:
+            await save_watermark(repo, user_id, result)
+        logger.info(f"Successfully sent messages {fmt} file ({result.rows} rows) to admin {user_id}")
     
     except Exception as e:
         error_msg = f"Error handling messages download: {str(e)}"
         logger.error(error_msg)
-        await message.reply("❌ Error generating report. Please try again later.")
\ No newline at end of file
+        await message.reply("❌ Error generating report. Please try again later.")
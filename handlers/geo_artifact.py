@@ -0,0 +1,244 @@
+"""
+COUNTRY_MAP.json compiled into a versioned binary file that is memory-mapped.
+
+    python -m handlers.geo_artifact [COUNTRY_MAP.json] [COUNTRY_MAP.geoidx]
+
+The artifact stores the SHA-256 of the JSON it was built from, and
+load_geo_index() rebuilds it whenever the JSON or ARTIFACT_VERSION changes.
+It is opened read-only with mmap, so bot processes on one host share its
+pages through the OS page cache.
+
+Layout: a little-endian header (magic, version, byte order, source hash,
+counts, then offset and length of every section), followed by the sections
+in SECTIONS order. Numeric sections use the native byte order of the host
+that built them; a host with another byte order simply rebuilds.
+
+    codes        country codes, NUL-separated UTF-8, in map order
+    alias_code   u16 per alias: index into codes
+    alias_start  u32 per alias: offset into alias_blob
+    alias_size   u16 per alias: UTF-8 length in bytes
+    alias_len    u16 per alias: length in characters
+    alias_blob   normalized aliases (clean_word), UTF-8, back to back
+    exact        u32 open-addressing table keyed by FNV-1a of the alias:
+                 alias index + 1, 0 for an empty slot; a later alias
+                 replaces an earlier equal one, like GeoIndex.exact
+    alphabet     every character used by the aliases, UTF-8, sorted
+    char_counts  u8 matrix, one row per alphabet character, one column per
+                 alias: how many times the character occurs in the alias
+                 (GeoIndex.candidates reads it without copying)
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from handlers.geo_index import MATCH_CACHE_SIZE, GeoIndex, char_counts, clean_word
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_VERSION = 2
+MAGIC = b"GEOIDX\0\0"
+SECTIONS = (
+    "codes", "alias_code", "alias_start", "alias_size", "alias_len", "alias_blob",
+    "exact", "alphabet", "char_counts"
+)
+_HEADER = struct.Struct("<8sIB3x32sIII" + "II" * len(SECTIONS))
+_BYTEORDER = {"little": 1, "big": 2}[sys.byteorder]
+
+
+def fnv1a(text: str) -> int:
+    """32-bit FNV-1a of the UTF-8 bytes; stable across processes unlike hash()"""
+    value = 0x811C9DC5
+    for byte in text.encode("utf-8"):
+        value = ((value ^ byte) * 0x01000193) & 0xFFFFFFFF
+    return value
+
+
+def _pad(blob: bytes) -> bytes:
+    return blob + b"\0" * (-len(blob) % 4)
+
+
+def compile_artifact(country_map: dict, source_hash: bytes) -> bytes:
+    """Serialize a country map into the artifact format"""
+    codes = list(country_map)
+    aliases, alias_code = [], array("H")
+    for code_index, names in enumerate(country_map.values()):
+        for name in names:
+            aliases.append(clean_word(name))
+            alias_code.append(code_index)
+
+    alias_start, alias_size, alias_len = array("I"), array("H"), array("H")
+    blob = bytearray()
+    for alias in aliases:
+        encoded = alias.encode("utf-8")
+        alias_start.append(len(blob))
+        alias_size.append(len(encoded))
+        alias_len.append(len(alias))
+        blob += encoded
+
+    slots = 1
+    while slots < 2 * max(1, len(aliases)):
+        slots *= 2
+    exact = array("I", [0]) * slots
+    for index, alias in enumerate(aliases):
+        slot = fnv1a(alias) & (slots - 1)
+        while exact[slot] and aliases[exact[slot] - 1] != alias:
+            slot = (slot + 1) & (slots - 1)
+        exact[slot] = index + 1
+
+    alphabet, counts = char_counts(aliases)
+
+    sections = {
+        "codes": "\0".join(codes).encode("utf-8"),
+        "alias_code": alias_code.tobytes(),
+        "alias_start": alias_start.tobytes(),
+        "alias_size": alias_size.tobytes(),
+        "alias_len": alias_len.tobytes(),
+        "alias_blob": bytes(blob),
+        "exact": exact.tobytes(),
+        "alphabet": alphabet.encode("utf-8"),
+        "char_counts": counts.tobytes()
+    }
+
+    body = bytearray()
+    layout = []
+    for name in SECTIONS:
+        layout += [_HEADER.size + len(body), len(sections[name])]
+        body += _pad(sections[name])
+
+    header = _HEADER.pack(
+        MAGIC, ARTIFACT_VERSION, _BYTEORDER, source_hash,
+        len(codes), len(aliases), len(alphabet), *layout
+    )
+    return header + bytes(body)
+
+
+def build_artifact(json_path: str, artifact_path: str) -> bytes:
+    """Compile json_path into artifact_path atomically; returns the source hash"""
+    with open(json_path, "rb") as f:
+        source = f.read()
+    source_hash = hashlib.sha256(source).digest()
+    data = compile_artifact(json.loads(source.decode("utf-8")), source_hash)
+
+    directory = os.path.dirname(os.path.abspath(artifact_path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".geoidx_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # несколько процессов могут собирать одновременно — replace атомарен
+        os.replace(tmp_path, artifact_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    logger.info(f"GEO artifact {artifact_path} built ({len(data)} bytes)")
+    return source_hash
+
+
+class GeoArtifact:
+    """
+    Read-only view of a compiled artifact. Aliases are decoded once (rapidfuzz
+    needs a list of str); exact lookups and character counts read the
+    memory-mapped sections directly.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError("file is too short")
+
+        fields = _HEADER.unpack_from(self._mmap)
+        magic, self.version, self.byteorder, self.source_hash = fields[:4]
+        if magic != MAGIC:
+            raise ValueError("not a GEO artifact")
+        if self.version != ARTIFACT_VERSION or self.byteorder != _BYTEORDER:
+            # другая версия формата — данные не разбираем, её пересоберут
+            return
+
+        n_codes, n_aliases, n_chars = fields[4:7]
+        layout = fields[7:]
+        if max(layout[i] + layout[i + 1] for i in range(0, len(layout), 2)) > len(self._mmap):
+            raise ValueError("file is truncated")
+        view = memoryview(self._mmap)
+        section = {
+            name: view[layout[2 * i]:layout[2 * i] + layout[2 * i + 1]]
+            for i, name in enumerate(SECTIONS)
+        }
+
+        self.codes = bytes(section["codes"]).decode("utf-8").split("\0") if n_codes else []
+        alias_code = section["alias_code"].cast("H")
+        alias_start = section["alias_start"].cast("I")
+        alias_size = section["alias_size"].cast("H")
+        blob = section["alias_blob"]
+        self.aliases = [
+            bytes(blob[alias_start[i]:alias_start[i] + alias_size[i]]).decode("utf-8")
+            for i in range(n_aliases)
+        ]
+        self.alias_codes = [self.codes[alias_code[i]] for i in range(n_aliases)]
+        self.alias_len = section["alias_len"].cast("H")
+        self._exact = section["exact"].cast("I")
+        self.alphabet = bytes(section["alphabet"]).decode("utf-8")
+        if len(self.alphabet) != n_chars:
+            raise ValueError("alphabet does not match the header")
+        import numpy as np
+
+        self.char_counts = np.frombuffer(section["char_counts"], dtype=np.uint8).reshape(n_chars, n_aliases)
+
+    def is_current(self, source_hash: bytes) -> bool:
+        return (
+            self.version == ARTIFACT_VERSION
+            and self.byteorder == _BYTEORDER
+            and self.source_hash == source_hash
+        )
+
+    def get(self, alias: str, default=None):
+        """ISO code for an exact (normalized) alias, like dict.get on GeoIndex.exact"""
+        mask = len(self._exact) - 1
+        slot = fnv1a(alias) & mask
+        while True:
+            entry = self._exact[slot]
+            if not entry:
+                return default
+            if self.aliases[entry - 1] == alias:
+                return self.alias_codes[entry - 1]
+            slot = (slot + 1) & mask
+
+
+def load_geo_index(json_path: str, artifact_path: str, cache_size: int = MATCH_CACHE_SIZE) -> GeoIndex:
+    """
+    GeoIndex backed by the compiled artifact, rebuilt first when it is
+    missing, built from another JSON or by another ARTIFACT_VERSION.
+    Falls back to parsing the JSON when the artifact can't be written.
+    """
+    with open(json_path, "rb") as f:
+        source_hash = hashlib.sha256(f.read()).digest()
+
+    try:
+        artifact = GeoArtifact(artifact_path)
+        if artifact.is_current(source_hash):
+            return GeoIndex.from_artifact(artifact, cache_size)
+        logger.info(f"GEO artifact {artifact_path} is out of date, rebuilding")
+    except FileNotFoundError:
+        logger.info(f"GEO artifact {artifact_path} not found, building")
+    except ValueError as e:
+        logger.warning(f"GEO artifact {artifact_path} is invalid ({e}), rebuilding")
+
+    try:
+        build_artifact(json_path, artifact_path)
+        return GeoIndex.from_artifact(GeoArtifact(artifact_path), cache_size)
+    except OSError as e:
+        logger.warning(f"Can't write GEO artifact {artifact_path} ({e}), using {json_path} directly")
+        with open(json_path, "r", encoding="utf-8") as f:
+            return GeoIndex(json.load(f), cache_size)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    json_path = sys.argv[1] if len(sys.argv) > 1 else "COUNTRY_MAP.json"
+    artifact_path = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(json_path)[0] + ".geoidx"
+    build_artifact(json_path, artifact_path)
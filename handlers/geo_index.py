@@ -0,0 +1,184 @@
+import logging
+from collections import Counter
+from functools import lru_cache
+
+from rapidfuzz import process, fuzz
+
+logger = logging.getLogger(__name__)
+
+# Минимальный fuzz.ratio, при котором слово считается GEO
+GEO_SCORE_THRESHOLD = 70
+# Сколько разных слов помнит GeoIndex.match, включая слова без GEO
+MATCH_CACHE_SIZE = 10000
+
+
+def clean_word(word: str) -> str:
+    """Приводим слово к виду, в котором хранятся алиасы"""
+    return word.strip().replace("ё", "е").upper()
+
+
+def char_counts(aliases):
+    """
+    Alphabet of the aliases and a uint8 matrix: counts[i, j] is how many
+    times alphabet[i] occurs in aliases[j]
+    """
+    # numpy грузится только при сборке индекса, а не при импорте handlers
+    import numpy as np
+
+    alphabet = sorted({char for alias in aliases for char in alias})
+    row = {char: i for i, char in enumerate(alphabet)}
+    counts = np.zeros((len(alphabet), len(aliases)), dtype=np.uint8)
+    for j, alias in enumerate(aliases):
+        if len(alias) > 255:
+            raise ValueError(f"GEO alias is too long: {alias[:20]}...")
+        for char, count in Counter(alias).items():
+            counts[row[char], j] = count
+    return "".join(alphabet), counts
+
+
+class GeoIndex:
+    """
+    Alias index built once from COUNTRY_MAP.
+
+    Exact aliases are resolved with a dict lookup; everything else goes through
+    a single rapidfuzz pass over the aliases that can still reach the cutoff
+    (see candidates). Tie-breaking matches the old per-country scan: the
+    highest score wins, and on equal scores the country listed later in
+    COUNTRY_MAP wins.
+
+    Results, misses included, are kept in a per-index LRU cache of
+    `cache_size` words: partners repeat the same few tokens all day. A
+    reloaded map is a new GeoIndex, so it starts with an empty cache.
+    """
+
+    def __init__(self, country_map: dict, cache_size: int = MATCH_CACHE_SIZE):
+        self.country_map = country_map
+        self.aliases = []      # плоский список всех алиасов
+        self.alias_codes = []  # alias_codes[i] — ISO-код для aliases[i]
+        self.exact = {}        # alias -> ISO-код (последняя страна побеждает)
+
+        for geo_code, names in country_map.items():
+            for name in names:
+                # алиасы храним в том же виде, что и слова пользователя
+                name = clean_word(name)
+                self.aliases.append(name)
+                self.alias_codes.append(geo_code)
+                self.exact[name] = geo_code
+
+        self._init_candidates(*char_counts(self.aliases), [len(alias) for alias in self.aliases])
+        self._cached_match = lru_cache(maxsize=cache_size)(self._match)
+
+        logger.info(f"GEO index built: {len(country_map)} countries, {len(self.aliases)} aliases")
+
+    @classmethod
+    def from_artifact(cls, artifact, cache_size: int = MATCH_CACHE_SIZE) -> "GeoIndex":
+        """
+        Index over a compiled GeoArtifact: exact lookups probe its
+        memory-mapped hash table instead of a dict, and the character
+        counts are read straight from the mapping
+        """
+        index = cls.__new__(cls)
+        index.aliases = artifact.aliases
+        index.alias_codes = artifact.alias_codes
+        index.exact = artifact
+        index._init_candidates(artifact.alphabet, artifact.char_counts, artifact.alias_len)
+        index._cached_match = lru_cache(maxsize=cache_size)(index._match)
+        index.country_map = {code: [] for code in artifact.codes}
+        for alias, code in zip(artifact.aliases, artifact.alias_codes):
+            index.country_map[code].append(alias)
+
+        logger.info(
+            f"GEO index loaded from artifact v{artifact.version}: "
+            f"{len(artifact.codes)} countries, {len(index.aliases)} aliases"
+        )
+        return index
+
+    def _init_candidates(self, alphabet: str, counts: "numpy.ndarray", alias_lengths):
+        import numpy as np
+
+        self.alphabet = {char: i for i, char in enumerate(alphabet)}
+        self.char_counts = counts
+        # ratio >= порога  <=>  200 * LCS >= порог * (len1 + len2); правая часть без len1
+        self.alias_cutoffs = GEO_SCORE_THRESHOLD * np.array(alias_lengths, dtype=np.int32)
+
+    def candidates(self, word_clean: str) -> "numpy.ndarray":
+        """
+        Indexes of the aliases that can score GEO_SCORE_THRESHOLD or more.
+
+        fuzz.ratio is 200 * LCS / (len1 + len2), and the LCS is never longer
+        than the number of characters both strings share (with repeats), so
+        aliases whose shared count is already too low are dropped without
+        losing a match. This also drops aliases of very different length.
+        Trigram counts give no usable bound at a cutoff of 70, single
+        characters do.
+        """
+        import numpy as np
+
+        rows, counts = [], []
+        for char, count in Counter(word_clean).items():
+            row = self.alphabet.get(char)
+            if row is not None:
+                rows.append(row)
+                # в алиасе символ встречается не больше 255 раз
+                counts.append(min(count, 255))
+        if not rows:
+            return np.empty(0, dtype=np.intp)
+
+        shared = np.minimum(self.char_counts[rows], np.array(counts, dtype=np.uint8)[:, None])
+        shared = shared.sum(axis=0, dtype=np.int32)
+        return np.flatnonzero(200 * shared - GEO_SCORE_THRESHOLD * len(word_clean) >= self.alias_cutoffs)
+
+    def match(self, word_clean: str):
+        """Return ISO code for an already cleaned word, or None"""
+        return self._cached_match(word_clean)
+
+    def _match(self, word_clean: str):
+        geo_code = self.exact.get(word_clean)
+        if geo_code is not None:
+            return geo_code
+
+        candidates = self.candidates(word_clean)
+        if not len(candidates):
+            return None
+
+        results = process.extract(
+            word_clean,
+            [self.aliases[i] for i in candidates],
+            scorer=fuzz.ratio,
+            score_cutoff=GEO_SCORE_THRESHOLD,
+            limit=None
+        )
+        if not results:
+            return None
+
+        # results отсортированы по убыванию score; среди равных берём
+        # алиас с наибольшим индексом, т.е. страну, стоящую в карте позже
+        top_score = results[0][1]
+        best_index = max(candidates[index] for _, score, index in results if score == top_score)
+        return self.alias_codes[best_index]
+
+    def stats(self) -> dict:
+        info = self._cached_match.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "size": info.currsize,
+            "max_size": info.maxsize,
+            "hits": info.hits,
+            "misses": info.misses,
+            "hit_rate": round(info.hits / lookups, 3) if lookups else 0.0
+        }
+
+
+def normalize_geo(user_words, geo_index: GeoIndex):
+    correct = []
+    incorrect = []
+
+    for word in user_words:
+        best_match = geo_index.match(clean_word(word))
+
+        if best_match:
+            correct.append(best_match)
+        else:
+            incorrect.append(word)
+
+    return correct, incorrect
@@ -2,19 +2,22 @@ import logging
 from datetime import datetime
 from aiogram import types
 
+from writers import messages_writer
+
 logger = logging.getLogger(__name__)
 
-async def log_other_messages(message: types.Message, supabase):
+async def log_other_messages(message: types.Message, repo):
     """Log messages that are not GEO codes or GEO errors"""
     try:
         now = datetime.utcnow().isoformat()
         
-        response = supabase.table("messages").insert({
+        # буферизуется и пишется пачкой в фоне
+        messages_writer.submit("messages", {
             "user_id": message.from_user.id,
             "username": message.from_user.username,
             "text": message.text,
             "message_date": now
-        }).execute()
+        })
         
         logger.info(f"Logged other message from user {message.from_user.username}")
         return True
@@ -22,10 +25,10 @@ async def log_other_messages(message: types.Message, supabase):
         logger.error(f"Failed to log other message: {str(e)}")
         return False
 
-async def handle_other_message(message: types.Message, supabase):
+async def handle_other_message(message: types.Message, repo):
     """Handler for non-GEO messages"""
     try:
-        await log_other_messages(message, supabase)
+        await log_other_messages(message, repo)
         await message.reply(
             "👋 Hi! I'm designed to help with GEO codes. "
             "Please send country codes like US, UK, AU etc. "
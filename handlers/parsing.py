@@ -0,0 +1,62 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+
+from handlers.geo_index import GeoIndex, normalize_geo
+from metrics import stage_seconds
+
+logger = logging.getLogger(__name__)
+
+# Сколько GEO из одного сообщения обрабатываем, остальные отбрасываем
+MAX_GEOS_PER_REQUEST = 200
+
+
+@dataclass
+class ParsedMessage:
+    """Результат разбора текста сообщения на GEO"""
+    words: List[str] = field(default_factory=list)
+    correct_geos: List[str] = field(default_factory=list)
+    incorrect_words: List[str] = field(default_factory=list)
+    dropped_geos: int = 0  # сколько GEO не влезло в MAX_GEOS_PER_REQUEST
+
+
+def parse_message(text: str, geo_index: GeoIndex) -> ParsedMessage:
+    """Split the text and normalize every word against the GEO index"""
+    words = text.strip().replace(",", " ").split()
+    correct_geos, incorrect_words = normalize_geo(words, geo_index)
+
+    dropped_geos = max(0, len(correct_geos) - MAX_GEOS_PER_REQUEST)
+    if dropped_geos:
+        logger.warning(f"Message has {len(correct_geos)} GEOs, keeping first {MAX_GEOS_PER_REQUEST}")
+        correct_geos = correct_geos[:MAX_GEOS_PER_REQUEST]
+
+    return ParsedMessage(
+        words=words,
+        correct_geos=correct_geos,
+        incorrect_words=incorrect_words,
+        dropped_geos=dropped_geos
+    )
+
+
+class ParseGeoMiddleware(BaseMiddleware):
+    """
+    Parses the message once per update and puts the result into handler data
+    as `parsed`. Only runs for handlers registered with flags={"parse_geo": True}.
+    """
+
+    def __init__(self, geo_index: GeoIndex):
+        self.geo_index = geo_index
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.Message,
+        data: Dict[str, Any]
+    ) -> Any:
+        if "parsed" not in data and get_flag(data, "parse_geo") and event.text:
+            with stage_seconds.time(stage="parse_geo"):
+                data["parsed"] = parse_message(event.text, self.geo_index)
+        return await handler(event, data)
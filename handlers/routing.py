@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Как долго (в секундах) держим таблицу geo в памяти без перечитывания
+DEFAULT_GEO_CACHE_TTL = 300
+
+
+class GeoRoutingCache:
+    """
+    In-memory GEO -> team rows index built from the whole `geo` table.
+
+    The table only changes through /add, /change and /delete, so it is loaded
+    once, refreshed every `ttl` seconds and dropped explicitly by the admin
+    commands via invalidate(). With ttl <= 0 caching is off and every message
+    is resolved with a single array-overlap query instead.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_GEO_CACHE_TTL):
+        self.ttl = ttl
+        self._index = None
+        self._loaded_at = 0.0
+        # растёт при каждом invalidate(): загрузка, начатая раньше, устарела
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._index = None
+        self._generation += 1
+        logger.info("GEO routing cache invalidated")
+
+    def _is_fresh(self) -> bool:
+        return self._index is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def _load(self, repo) -> dict:
+        rows = await repo.fetch_geo_teams()
+
+        index = {}  # geo -> list of rows
+        for row in rows:
+            for geo in row.get("geos") or []:
+                index.setdefault(geo, []).append(row)
+
+        logger.info(f"GEO routing cache loaded: {len(rows)} teams, {len(index)} GEOs")
+        return index
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    async def _resolve_bulk(self, repo, geos) -> dict:
+        """One `geos && {...}` query for all requested GEOs"""
+        result = {geo: [] for geo in geos}
+        if not result:
+            return result
+
+        for row in await repo.fetch_geo_teams_overlapping(list(result)):
+            for geo in row.get("geos") or []:
+                if geo in result:
+                    result[geo].append(row)
+        return result
+
+    async def get(self, repo) -> dict:
+        """Return the GEO -> team rows index, reloading it if stale"""
+        if self._is_fresh():
+            return self._index
+
+        async with self._lock:
+            # пока ждали лок, индекс мог обновить другой запрос
+            if self._is_fresh():
+                return self._index
+            while True:
+                generation = self._generation
+                index = await self._load(repo)
+                # если за время загрузки был invalidate(), строки могли
+                # прочитаться до правки админа — читаем заново
+                if generation == self._generation:
+                    self._index = index
+                    self._loaded_at = time.monotonic()
+                    return index
+
+    async def resolve(self, repo, geos) -> dict:
+        """Map every requested GEO to the team rows that serve it"""
+        if not self.enabled:
+            return await self._resolve_bulk(repo, geos)
+
+        index = await self.get(repo)
+        return {geo: index.get(geo, []) for geo in geos}
+
+
+def group_geos_by_team(geos, geo_team_map) -> list:
+    """
+    Build the "GEO: a, b – Team" reply lines.
+
+    Every team is listed once, next to exactly the GEOs it serves. Lines are
+    ordered the way the old combinations() search emitted them: bigger GEO
+    groups first, then by the position of the GEOs in the message.
+    Runs in O(len(geos) * teams) instead of 2^len(geos).
+    """
+    team_positions = {}  # team -> позиции GEO в сообщении, которые она закрывает
+    for position, geo in enumerate(geos):
+        for team in geo_team_map.get(geo, ()):
+            team_positions.setdefault(team, []).append(position)
+
+    groups = {}  # tuple позиций -> команды с ровно таким набором GEO
+    for team, positions in team_positions.items():
+        groups.setdefault(tuple(positions), []).append(team)
+
+    lines = []
+    for positions in sorted(groups, key=lambda p: (-len(p), p)):
+        lines.append(f"GEO: {', '.join(geos[i] for i in positions)} – " + ", ".join(groups[positions]))
+    return lines
+
+
+geo_routing = GeoRoutingCache()
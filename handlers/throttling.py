@@ -0,0 +1,150 @@
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+
+logger = logging.getLogger(__name__)
+
+# Сколько пользователей помним одновременно; самые давние вытесняются
+DEFAULT_MAX_USERS = 10000
+# Как часто (секунды) одному пользователю напоминаем, что он упёрся в лимит
+NOTICE_INTERVAL = 30.0
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Token bucket: `rate` tokens per second, at most `burst` saved up"""
+    rate: float
+    burst: float
+
+    @classmethod
+    def parse(cls, value: str) -> "RateLimit":
+        """'0.2:5' -> RateLimit(rate=0.2, burst=5)"""
+        rate, burst = value.split(":")
+        return cls(float(rate), float(burst))
+
+
+# имя лимита (флаг rate_limit хендлера) -> (лимит на пользователя, общий лимит)
+DEFAULT_LIMITS = {
+    "geo": (RateLimit(0.2, 5), RateLimit(10, 30)),
+    "other": (RateLimit(0.5, 5), RateLimit(30, 60)),
+    "export": (RateLimit(1 / 60, 3), RateLimit(0.2, 2))
+}
+
+
+class TokenBuckets:
+    """
+    Token buckets for many keys in one LRU-ordered dict.
+
+    A bucket is just [tokens, last refill time, last notice time] and is
+    refilled lazily when touched. Only the `max_size` most recently seen
+    keys are kept; an evicted key starts over with a full bucket.
+    """
+
+    def __init__(self, limit: RateLimit, max_size: int = DEFAULT_MAX_USERS):
+        self.limit = limit
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def _bucket(self, key, now: float) -> list:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.limit.burst, now, 0.0]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.limit.burst, bucket[0] + (now - bucket[1]) * self.limit.rate)
+            bucket[1] = now
+        return bucket
+
+    def take(self, key, now: float) -> bool:
+        """Spend one token; False when the bucket is empty"""
+        bucket = self._bucket(key, now)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def reserve(self, key, now: float) -> float:
+        """
+        Spend one token even if the bucket is empty and return how many
+        seconds the caller has to wait for it; reservations keep their order
+        """
+        bucket = self._bucket(key, now)
+        bucket[0] -= 1
+        return 0.0 if bucket[0] >= 0 else -bucket[0] / self.limit.rate
+
+    def should_notice(self, key, now: float) -> bool:
+        """True at most once per NOTICE_INTERVAL for a key"""
+        bucket = self._bucket(key, now)
+        if now - bucket[2] < NOTICE_INTERVAL:
+            return False
+        bucket[2] = now
+        return True
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Drops updates from users who go over their limit before the handler
+    (and its database queries and replies) runs.
+
+    Only handlers registered with flags={"rate_limit": "<name>"} are limited.
+    Each name has a per-user bucket and a global bucket shared by everyone.
+    A throttled user is told to slow down at most once per NOTICE_INTERVAL.
+    Register it before ParseGeoMiddleware so dropped messages are not parsed.
+    """
+
+    def __init__(self, limits: Dict[str, tuple] = None, max_users: int = DEFAULT_MAX_USERS):
+        limits = limits or DEFAULT_LIMITS
+        self.per_user = {name: TokenBuckets(user_limit, max_users) for name, (user_limit, _) in limits.items()}
+        self.overall = {name: TokenBuckets(global_limit, 1) for name, (_, global_limit) in limits.items()}
+        self.allowed = {name: 0 for name in limits}
+        self.throttled = {name: 0 for name in limits}
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = get_flag(data, "rate_limit")
+        user = data.get("event_from_user")
+        if name not in self.per_user or user is None:
+            return await handler(event, data)
+
+        now = time.monotonic()
+        # сначала личный лимит, чтобы один пользователь не съедал общий
+        own_ok = self.per_user[name].take(user.id, now)
+        if own_ok and self.overall[name].take(None, now):
+            self.allowed[name] += 1
+            return await handler(event, data)
+
+        self.throttled[name] += 1
+        logger.warning(f"Rate limit '{name}' hit by user {user.id}{' (global)' if own_ok else ''}")
+        if self.per_user[name].should_notice(user.id, now):
+            if own_ok:
+                await event.answer("⏳ The bot is busy right now, please try again in a minute.")
+            else:
+                await event.answer("⏳ Too many requests, please slow down and try again in a minute.")
+        elif isinstance(event, types.CallbackQuery):
+            await event.answer()  # убрать "часики"
+        return None
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "allowed": self.allowed[name],
+                "throttled": self.throttled[name],
+                "tracked_users": len(self.per_user[name])
+            }
+            for name in self.per_user
+        }
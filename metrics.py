@@ -0,0 +1,182 @@
+"""
+Latency histograms and counters in Prometheus text format, served at /metrics.
+
+Kept dependency-free: a handful of metric types with a lock each is all the
+bot needs, and observations may come from worker threads (exports).
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []  # метрики в порядке создания
+_collectors = {}  # префикс -> (функция stats(), имя метки)
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            for key, value in self._values.items():
+                yield f"{self.name}{_format_labels(self.labels, key)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # метки -> [счётчики по корзинам..., сумма, количество]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            for key, series in self._series.items():
+                names = self.labels + ("le",)
+                for bound, count in zip(self.buckets, series):
+                    yield f"{self.name}_bucket{_format_labels(names, key + (bound,))} {count}"
+                yield f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {series[-1]}"
+                yield f"{self.name}_sum{_format_labels(self.labels, key)} {series[-2]}"
+                yield f"{self.name}_count{_format_labels(self.labels, key)} {series[-1]}"
+
+
+def register_stats(prefix: str, stats: Callable[[], dict], label: str = None):
+    """
+    Expose the numeric values of a stats() dict as gauges named
+    <prefix>_<key>. With `label`, stats() returns {label value: {key: value}}.
+    Registering a prefix again replaces the previous collector, so building
+    the app twice doesn't repeat metric families.
+    """
+    _collectors[prefix] = (stats, label)
+
+
+def _render_stats():
+    for prefix, (stats, label) in list(_collectors.items()):
+        try:
+            values = stats()
+        except Exception as e:
+            logger.error(f"Failed to collect {prefix} stats: {e}")
+            continue
+        rows = values.items() if label else [(None, values)]
+        gauges = {}
+        for label_value, fields in rows:
+            for key, value in fields.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                labels = _format_labels((label,), (label_value,)) if label else ""
+                gauges.setdefault(f"{prefix}_{key}", []).append(f"{labels} {value}")
+        for name, samples in gauges.items():
+            yield f"# TYPE {name} gauge"
+            for sample in samples:
+                yield f"{name}{sample}"
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    lines.extend(_render_stats())
+    return "\n".join(lines) + "\n"
+
+
+# --- метрики бота ---
+
+handler_seconds = Histogram("bot_handler_seconds", "Time spent in update handlers", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Exceptions raised by update handlers", ("handler",))
+stage_seconds = Histogram("bot_stage_seconds", "Time spent in individual processing stages", ("stage",))
+supabase_seconds = Histogram("supabase_query_seconds", "Supabase query latency", ("table", "op"))
+supabase_errors = Counter("supabase_query_errors_total", "Failed Supabase queries", ("table", "op"))
+telegram_seconds = Histogram("telegram_request_seconds", "Telegram Bot API request latency", ("method",))
+telegram_errors = Counter("telegram_request_errors_total", "Failed Telegram Bot API requests", ("method",))
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Records how long each handler takes and how often it raises"""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "unknown") if handler_object else "unknown"
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler=name)
+
+
+class RequestTimingMiddleware(BaseRequestMiddleware):
+    """
+    Records Bot API latency per method. Register it after SendScheduler so
+    time spent waiting for a send slot is not counted.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            telegram_errors.inc(method=name)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, method=name)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from metrics import supabase_errors, supabase_seconds
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 10.0
+
+
+def query_labels(query):
+    """(table, operation) of a postgrest request builder, for metrics"""
+    table = getattr(query, "path", "/unknown").lstrip("/")
+    method = str(getattr(getattr(query, "http_method", None), "value", "")).upper()
+    if method == "POST":
+        prefer = getattr(query, "headers", {}).get("prefer", "")
+        return table, "upsert" if "resolution=" in prefer else "insert"
+    return table, {"GET": "select", "PATCH": "update", "DELETE": "delete"}.get(method, "unknown")
+
+
+def execute_query(query):
+    """Run a built query (blocking) and record its latency per table and operation"""
+    table, op = query_labels(query)
+    start = time.perf_counter()
+    try:
+        return query.execute()
+    except Exception:
+        supabase_errors.inc(table=table, op=op)
+        raise
+    finally:
+        supabase_seconds.observe(time.perf_counter() - start, table=table, op=op)
+
+
+class Repository:
+    """
+    Async access to Supabase tables.
+
+    supabase-py is synchronous, so every `.execute()` runs on a bounded thread
+    pool instead of the event loop. A semaphore caps the number of queries in
+    flight and each call fails with asyncio.TimeoutError after `timeout` seconds.
+    """
+
+    def __init__(self, client, max_workers: int = DEFAULT_MAX_WORKERS, timeout: float = DEFAULT_TIMEOUT):
+        self.client = client
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="supabase")
+        self._semaphore = asyncio.Semaphore(max_workers)
+
+    async def execute(self, build_query: Callable, timeout: float = None):
+        """
+        Execute a query built by `build_query(client)` off the event loop.
+        Returns the whole response (data and count).
+        """
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            future = loop.run_in_executor(self._executor, lambda: execute_query(build_query(self.client)))
+            return await asyncio.wait_for(future, timeout or self.timeout)
+
+    async def run(self, build_query: Callable, timeout: float = None):
+        """Same as execute(), returns only the response data"""
+        response = await self.execute(build_query, timeout)
+        return response.data
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    # --- generic ---
+
+    async def insert(self, table: str, rows) -> List[dict]:
+        """Insert one row (dict) or many rows (list of dicts)"""
+        return await self.run(lambda c: c.table(table).insert(rows))
+
+    # --- geo ---
+
+    async def fetch_geo_teams(self) -> List[dict]:
+        """All rows of the geo routing table"""
+        return await self.run(lambda c: c.table("geo").select("*"))
+
+    async def fetch_geo_teams_overlapping(self, geos) -> List[dict]:
+        """Rows whose `geos` array overlaps the given GEO set"""
+        pg_array = "{" + ",".join(geos) + "}"
+        return await self.run(lambda c: c.table("geo").select("*").filter("geos", "ov", pg_array))
+
+    async def get_team_contacts(self, team: str) -> List[dict]:
+        return await self.run(lambda c: c.table("geo").select("contact").eq("team_name", team))
+
+    async def update_team_contacts(self, team: str, contacts) -> List[dict]:
+        return await self.run(lambda c: c.table("geo").update({"contact": contacts}).eq("team_name", team))
+
+    async def create_team(self, team: str, contacts: list) -> List[dict]:
+        return await self.run(lambda c: c.table("geo").insert({
+            "team_name": team,
+            "contact": contacts,
+            "geos": []  # можно оставить пустым массивом
+        }))
+
+    # --- export watermarks ---
+    # export_watermarks(admin_id bigint, table_name text, watermark text,
+    #                   primary key (admin_id, table_name))
+
+    async def get_export_watermark(self, admin_id: int, table: str):
+        """
+        Largest id this admin has already exported (text), or None; older
+        watermarks hold a request_date/message_date (see TableSource.since_id)
+        """
+        rows = await self.run(
+            lambda c: c.table("export_watermarks").select("watermark")
+            .eq("admin_id", admin_id).eq("table_name", table)
+        )
+        return rows[0]["watermark"] if rows else None
+
+    async def set_export_watermark(self, admin_id: int, table: str, watermark: str) -> List[dict]:
+        return await self.run(lambda c: c.table("export_watermarks").upsert({
+            "admin_id": admin_id,
+            "table_name": table,
+            "watermark": watermark
+        }, on_conflict="admin_id,table_name"))
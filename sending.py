@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendAnimation, SendAudio, SendDocument, SendMediaGroup, SendPhoto, SendVideo
+
+from handlers.throttling import RateLimit, TokenBuckets
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат,
+# ~20 в минуту в группу. Небольшой запас на всплески, дальше ждём.
+GLOBAL_LIMIT = RateLimit(30, 30)
+PRIVATE_CHAT_LIMIT = RateLimit(1, 4)
+GROUP_CHAT_LIMIT = RateLimit(20 / 60, 3)
+DEFAULT_MAX_CHATS = 10000
+DEFAULT_MAX_RETRIES = 3
+
+# Меньше — раньше уходит
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+BULK_METHODS = (SendDocument, SendMediaGroup, SendPhoto, SendVideo, SendAudio, SendAnimation)
+
+
+def _is_send(method) -> bool:
+    """Methods that post a message into a chat and count against the limits"""
+    return type(method).__name__.startswith(("Send", "Copy", "Forward")) and getattr(method, "chat_id", None) is not None
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Bot session middleware that paces every outgoing message.
+
+    Each chat has its own token bucket (groups get a tighter one). After
+    that a global bucket decides which waiting request goes next,
+    interactive replies before documents. Requests of one chat enter that
+    queue one at a time in call order, so priorities only reorder
+    different chats; the one exception is a request retried after a 429,
+    which queues again behind what the chat sent meanwhile. A 429 pauses
+    all sending for `retry_after` seconds and the request is retried up to
+    `max_retries` times. Other API calls (callback answers, webhook setup)
+    pass through untouched.
+
+    The pacing delay is awaited by the handler that sends, so it keeps its
+    update worker busy; UpdateWorkerPool shares workers between chats, so
+    only that chat waits.
+    """
+
+    def __init__(
+        self,
+        global_limit: RateLimit = GLOBAL_LIMIT,
+        private_limit: RateLimit = PRIVATE_CHAT_LIMIT,
+        group_limit: RateLimit = GROUP_CHAT_LIMIT,
+        max_chats: int = DEFAULT_MAX_CHATS,
+        max_retries: int = DEFAULT_MAX_RETRIES
+    ):
+        self.global_bucket = TokenBuckets(global_limit, 1)
+        self.private_buckets = TokenBuckets(private_limit, max_chats)
+        self.group_buckets = TokenBuckets(group_limit, max_chats)
+        self.max_retries = max_retries
+        self._waiting = []  # heap (priority, seq, future)
+        self._chat_tails = {}  # chat_id -> future последнего запроса чата в очереди
+        self._seq = itertools.count()
+        self._release_task = None
+        self._paused_until = 0.0
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.max_waiting = 0
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if not _is_send(method):
+            return await make_request(bot, method)
+
+        priority = PRIORITY_BULK if isinstance(method, BULK_METHODS) else PRIORITY_INTERACTIVE
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(method.chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+                logger.warning(f"Flood control on {type(method).__name__} to {method.chat_id}, retrying in {e.retry_after}s")
+
+    async def _wait_turn(self, chat_id, priority: int):
+        buckets = self.group_buckets if isinstance(chat_id, int) and chat_id < 0 else self.private_buckets
+        delay = buckets.reserve(chat_id, time.monotonic())
+
+        # в общую очередь чат ставит запросы по одному: иначе ответ обогнал бы
+        # документ того же чата, который ждёт слота с меньшим приоритетом
+        previous = self._chat_tails.get(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        self._chat_tails[chat_id] = future
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            if previous is not None and not previous.done():
+                await asyncio.wait([previous])
+
+            heapq.heappush(self._waiting, (priority, next(self._seq), future))
+            self.max_waiting = max(self.max_waiting, len(self._waiting))
+            if self._release_task is None or self._release_task.done():
+                self._release_task = asyncio.create_task(self._release(), name="send-scheduler")
+            await future
+        finally:
+            # отменённый запрос не должен держать следующие запросы чата
+            if not future.done():
+                future.cancel()
+            if self._chat_tails.get(chat_id) is future:
+                del self._chat_tails[chat_id]
+
+    async def _release(self):
+        """Let waiting requests go one at a time at the global rate"""
+        while self._waiting:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            delay = self.global_bucket.reserve(None, now)
+            if delay:
+                await asyncio.sleep(delay)
+            # берём самый приоритетный на момент, когда слот освободился
+            while self._waiting:
+                _, _, future = heapq.heappop(self._waiting)
+                if not future.done():
+                    future.set_result(None)
+                    break
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self._waiting),
+            "max_waiting": self.max_waiting,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "paused_for": max(0.0, round(self._paused_until - time.monotonic(), 1))
+        }
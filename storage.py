@@ -0,0 +1,244 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_CACHE_TTL = 0.0
+
+# (ключ, состояние, данные)
+FSMRecord = Tuple[str, Optional[str], Dict[str, Any]]
+
+
+def storage_key_id(key: StorageKey) -> str:
+    """Flatten a StorageKey into the primary key used by the backends"""
+    # business_connection_id появился в aiogram 3.4; без него в ключе та же "None"
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id,
+        getattr(key, "business_connection_id", None), key.destiny
+    ))
+
+
+class SQLiteFSMBackend:
+    """FSM records in a local SQLite file; for a single instance or local testing"""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS fsm_states ("
+                "key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL)"
+            )
+
+    def _load(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT state, data FROM fsm_states WHERE key = ?", (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def _save(self, records: List[FSMRecord]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fsm_states (key, state, data) VALUES (?, ?, ?)",
+                [(key, state, json.dumps(data, ensure_ascii=False)) for key, state, data in records]
+            )
+
+    def _delete(self, keys: List[str]):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM fsm_states WHERE key = ?", [(key,) for key in keys])
+
+    async def load(self, key: str):
+        return await asyncio.to_thread(self._load, key)
+
+    async def save(self, records: List[FSMRecord]):
+        await asyncio.to_thread(self._save, records)
+
+    async def delete(self, keys: List[str]):
+        await asyncio.to_thread(self._delete, keys)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SupabaseFSMBackend:
+    """
+    FSM records in a Supabase table shared by all bot instances:
+
+        fsm_states(key text primary key, state text, data jsonb not null default '{}',
+                   updated_at timestamptz not null default now())
+    """
+
+    def __init__(self, repo, table: str = "fsm_states"):
+        self.repo = repo
+        self.table = table
+
+    async def load(self, key: str):
+        rows = await self.repo.run(lambda c: c.table(self.table).select("state, data").eq("key", key))
+        return (rows[0]["state"], rows[0]["data"] or {}) if rows else None
+
+    async def save(self, records: List[FSMRecord]):
+        payload = [{"key": key, "state": state, "data": data} for key, state, data in records]
+        await self.repo.run(lambda c: c.table(self.table).upsert(payload, on_conflict="key"))
+
+    async def delete(self, keys: List[str]):
+        await self.repo.run(lambda c: c.table(self.table).delete().in_("key", keys))
+
+    def close(self):
+        pass  # соединения принадлежат Repository
+
+
+class WriteBehindStorage(BaseStorage):
+    """
+    aiogram FSM storage on top of a persistent backend.
+
+    Writes land in a local cache and are flushed to the backend in batches
+    every `flush_interval` seconds, so a handler never waits on the database
+    to change state. Reads are served from the cache while a write is still
+    pending or the entry is younger than `cache_ttl`, and from the backend
+    otherwise. Another instance sees a change at most `flush_interval`
+    seconds later; keep `cache_ttl` at 0 when several instances share the
+    backend, so a flow continued on another instance is never read stale.
+    """
+
+    def __init__(self, backend, flush_interval: float = DEFAULT_FLUSH_INTERVAL, cache_ttl: float = DEFAULT_CACHE_TTL):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self._cache = {}  # key -> [state, data, время загрузки]
+        self._dirty = set()
+        self._flushing = set()  # ключи, которые прямо сейчас пишутся в бэкенд
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._stop = asyncio.Event()
+        self._closed = False
+
+        self.reads = 0
+        self.backend_reads = 0
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def start(self):
+        if self._task is None and not self._closed:
+            self._task = asyncio.create_task(self._run(), name="fsm-flush")
+
+    def _pending(self, key_id: str) -> bool:
+        return key_id in self._dirty or key_id in self._flushing
+
+    async def _entry(self, key: StorageKey) -> list:
+        key_id = storage_key_id(key)
+        self.reads += 1
+        entry = self._cache.get(key_id)
+        if entry is not None and (self._pending(key_id) or time.monotonic() - entry[2] < self.cache_ttl):
+            return entry
+
+        self.backend_reads += 1
+        record = await self.backend.load(key_id)
+        # пока грузили, кто-то мог записать новое значение
+        if self._pending(key_id):
+            return self._cache[key_id]
+        state, data = record if record else (None, {})
+        entry = [state, data, time.monotonic()]
+        self._cache[key_id] = entry
+        return entry
+
+    async def _write(self, key: StorageKey, **changes):
+        key_id = storage_key_id(key)
+        entry = self._cache.get(key_id)
+        if entry is None or not self._pending(key_id):
+            # состояние и данные пишутся одной строкой — нужна вторая половина
+            entry = list(await self._entry(key))
+        if "state" in changes:
+            entry[0] = changes["state"]
+        if "data" in changes:
+            entry[1] = changes["data"]
+        entry[2] = time.monotonic()
+        self._cache[key_id] = entry
+        self._dirty.add(key_id)
+        self.start()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._write(key, data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._entry(key))[1])
+
+    async def flush(self):
+        """Write all pending changes to the backend"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys, self._dirty = self._dirty, set()
+            self._flushing = keys
+            saves, deletes = [], []
+            for key_id in keys:
+                state, data, _ = self._cache[key_id]
+                if state is None and not data:
+                    deletes.append(key_id)
+                else:
+                    saves.append((key_id, state, data))
+
+            try:
+                if saves:
+                    await self.backend.save(saves)
+                if deletes:
+                    await self.backend.delete(deletes)
+                self.flushes += 1
+            except Exception as e:
+                self.flush_errors += 1
+                # вернём ключи в очередь, если их не перезаписали за это время
+                self._dirty |= keys
+                logger.error(f"Failed to flush {len(keys)} FSM records: {e}")
+                return
+            finally:
+                self._flushing = set()
+
+            if self.cache_ttl <= 0:
+                for key_id in keys - self._dirty:
+                    self._cache.pop(key_id, None)
+
+    async def _run(self):
+        while not self._stop.is_set():
+            try:
+                await asyncio.wait_for(self._stop.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self._cache),
+            "pending": len(self._dirty),
+            "reads": self.reads,
+            "backend_reads": self.backend_reads,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors
+        }
+
+    async def close(self) -> None:
+        """Flush what is left and release the backend"""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._dirty:
+            logger.warning(f"{len(self._dirty)} FSM records were not persisted")
+        self.backend.close()
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable
+
+from aiogram import Bot, Dispatcher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 32
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_DEDUPE_SIZE = 10000
+DEFAULT_DEDUPE_TTL = 3600
+
+# Маркер остановки воркера
+_STOP = object()
+
+
+def update_chat_key(update: dict) -> int:
+    """
+    Pick the id that defines ordering for an update: the chat for messages
+    and callbacks, the sender otherwise, the update_id as a last resort.
+    """
+    for key, payload in update.items():
+        if key == "update_id" or not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = payload.get("from") or payload.get("user")
+        if sender and "id" in sender:
+            return sender["id"]
+    return update.get("update_id", 0)
+
+
+class UpdateDeduplicator:
+    """
+    Fixed-size window of recently accepted update_ids.
+
+    A ring buffer keeps ids in arrival order and a set answers lookups; ids
+    leave the window when it is full or when they are older than `ttl`.
+    """
+
+    def __init__(self, size: int = DEFAULT_DEDUPE_SIZE, ttl: float = DEFAULT_DEDUPE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._order = deque()  # (update_id, время добавления)
+        self._ids = set()
+        self.duplicates = 0
+
+    def _evict(self, now: float, reserve: int = 0):
+        while self._order and (len(self._order) + reserve > self.size or now - self._order[0][1] > self.ttl):
+            update_id, _ = self._order.popleft()
+            self._ids.discard(update_id)
+
+    def is_duplicate(self, update_id) -> bool:
+        self._evict(time.monotonic())
+        if update_id in self._ids:
+            self.duplicates += 1
+            return True
+        return False
+
+    def add(self, update_id):
+        now = time.monotonic()
+        self._evict(now, reserve=1)
+        self._order.append((update_id, now))
+        self._ids.add(update_id)
+
+
+class UpdateWorkerPool:
+    """
+    Processes webhook updates in the background so the webhook can answer
+    Telegram right away.
+
+    Every chat has its own FIFO of pending updates, and at most one update
+    per chat is in progress, so a chat sees its updates handled in order.
+    Workers are shared: any idle worker takes the next chat that has
+    something ready, so a slow update only holds up its own chat. Updates
+    matching `detached` (exports) skip the chat FIFO and run as their own
+    tasks. When `queue_size` updates are pending submit() returns False and
+    the webhook answers 503, which makes Telegram retry later. Redelivered
+    updates whose update_id was already accepted are dropped before dispatch.
+    """
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        workers: int = DEFAULT_WORKERS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        dedupe: UpdateDeduplicator = None,
+        detached: Callable[[dict], bool] = None
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self.queue_size = queue_size
+        self.dedupe = dedupe or UpdateDeduplicator()
+        self.detached = detached
+        self._chats = {}  # ключ чата -> deque апдейтов, пока чат в работе или в очереди
+        self._ready = asyncio.Queue()  # чаты, у которых есть апдейт и никто его не обрабатывает
+        self._detached_tasks = set()
+        self._pending = 0  # принятые, но ещё не обработанные апдейты
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._tasks = []
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"update-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} update workers")
+
+    def submit(self, update: dict) -> bool:
+        """Queue an update; False means the pool is full"""
+        update_id = update.get("update_id")
+        if self.dedupe.is_duplicate(update_id):
+            logger.info(f"Dropping duplicate update {update_id}")
+            return True
+
+        if self._pending >= self.queue_size:
+            self.rejected += 1
+            logger.warning(f"Update queue full, rejecting update {update_id}")
+            return False
+
+        if self.detached and self.detached(update):
+            task = asyncio.create_task(self._process(update), name=f"update-{update_id}")
+            self._detached_tasks.add(task)
+            task.add_done_callback(self._detached_tasks.discard)
+        else:
+            key = update_chat_key(update)
+            chat = self._chats.get(key)
+            if chat is None:
+                # чат свободен — его может взять любой воркер
+                chat = self._chats[key] = deque()
+                self._ready.put_nowait(key)
+            chat.append(update)
+
+        # отклонённые апдейты не запоминаем — Telegram пришлёт их повторно
+        self.dedupe.add(update_id)
+        self.enqueued += 1
+        self._pending += 1
+        self._drained.clear()
+        self.max_depth = max(self.max_depth, self._pending)
+        return True
+
+    async def _process(self, update: dict):
+        try:
+            await self.dp.feed_raw_update(self.bot, update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error processing update {update.get('update_id')}: {e}")
+        finally:
+            self._pending -= 1
+            if not self._pending:
+                self._drained.set()
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            if key is _STOP:
+                return
+            chat = self._chats[key]
+            await self._process(chat.popleft())
+            if chat:
+                # следующий апдейт чата — в конец очереди, чтобы не занимать воркер подряд
+                self._ready.put_nowait(key)
+            else:
+                del self._chats[key]
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self._pending,
+            "chats_pending": len(self._chats),
+            "detached_running": len(self._detached_tasks),
+            "queue_capacity": self.queue_size,
+            "max_depth": self.max_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "duplicates_dropped": self.dedupe.duplicates
+        }
+
+    async def close(self):
+        """Let workers finish everything already queued, then stop them"""
+        await self._drained.wait()
+        for _ in self._tasks:
+            self._ready.put_nowait(_STOP)
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+        logger.info("Update workers stopped")
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Маркер остановки: всё, что в очереди перед ним, будет записано
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    Fire-and-forget inserts for analytics tables.
+
+    Handlers call submit(table, row) and return immediately. A background task
+    drains the queue, groups rows by table and writes each group with one
+    multi-row insert, retrying with exponential backoff on failure.
+
+    Memory is bounded by `max_queue`. Rows that can't be queued or written are
+    dropped, or appended to `spill_path` (JSON lines, up to `max_spill_bytes`)
+    if it is set. After a successful insert the spill file is drained in the
+    background, at most `max_queue` rows at a time: it is renamed to
+    `<spill_path>.draining` first, so new spills keep appending to a fresh
+    file, and draining stops as soon as an insert fails again. Rows of a
+    chunk interrupted by close() are written again on the next drain.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        spill_path: str = None,
+        max_spill_bytes: int = 50 * 1024 * 1024
+    ):
+        self.name = name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.spill_path = spill_path
+        self.max_spill_bytes = max_spill_bytes
+
+        self.repo = None
+        self._queue = None
+        self._task = None
+        self._drain_task = None
+        self._closing = False
+
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def start(self, repo):
+        """Start the background task; must be called from the running event loop"""
+        self.repo = repo
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run(), name=f"{self.name}-writer")
+        self._drain_task = None
+        self._closing = False
+        logger.info(f"{self.name} writer started")
+
+    def submit(self, table: str, row: dict):
+        """Queue a row for insertion without waiting for the database"""
+        if self._queue is None:
+            raise RuntimeError(f"{self.name} writer is not started")
+        try:
+            self._queue.put_nowait((table, row))
+        except asyncio.QueueFull:
+            logger.error(f"{self.name} writer queue is full")
+            self._spill_or_drop(table, [row])
+
+    def _spill_or_drop(self, table: str, rows: list):
+        if self.spill_path:
+            try:
+                size = os.path.getsize(self.spill_path) if os.path.exists(self.spill_path) else 0
+                if size < self.max_spill_bytes:
+                    with open(self.spill_path, "a", encoding="utf-8") as f:
+                        for row in rows:
+                            f.write(json.dumps({"table": table, "row": row}, ensure_ascii=False) + "\n")
+                    self.spilled += len(rows)
+                    logger.warning(f"Spilled {len(rows)} rows for {table} to {self.spill_path}")
+                    return
+                logger.error(f"Spill file {self.spill_path} is full")
+            except OSError as e:
+                logger.error(f"Failed to spill rows to {self.spill_path}: {e}")
+
+        self.dropped += len(rows)
+        logger.error(f"Dropping {len(rows)} rows for {table}")
+
+    def _schedule_drain(self):
+        """Start draining spilled rows unless a drain is already running"""
+        if self._closing or (self._drain_task is not None and not self._drain_task.done()):
+            return
+        if not (os.path.exists(self.spill_path) or os.path.exists(self.spill_path + ".draining")):
+            return
+        self._drain_task = asyncio.create_task(self._drain_spill(), name=f"{self.name}-spill-drain")
+
+    def _read_spill(self, path: str, offset: int):
+        """Up to max_queue rows of path starting at offset; returns (rows, next offset)"""
+        rows = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while len(rows) < self.max_queue:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                try:
+                    item = json.loads(line)
+                    rows.append((item["table"], item["row"]))
+                except (ValueError, KeyError, TypeError):
+                    # недописанная строка после падения процесса
+                    continue
+        return rows, offset
+
+    @staticmethod
+    def _compact_spill(path: str, offset: int):
+        """Drop the first offset bytes of path, copying the rest without loading it"""
+        tmp_path = path + ".tmp"
+        with open(path, "rb") as src, open(tmp_path, "wb") as dst:
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp_path, path)
+
+    async def _drain_spill(self):
+        path = self.spill_path + ".draining"
+        offset = 0
+        try:
+            while True:
+                if not os.path.exists(path):
+                    if not os.path.exists(self.spill_path):
+                        return
+                    os.replace(self.spill_path, path)
+                    offset = 0
+
+                rows, next_offset = await asyncio.to_thread(self._read_spill, path, offset)
+                if not rows and next_offset == offset:
+                    os.remove(path)
+                    offset = 0
+                    continue
+
+                failures = self.spilled + self.dropped
+                await self._write(rows)
+                offset = next_offset
+                logger.info(f"Restored {len(rows)} spilled rows for {self.name} writer")
+                if self.spilled + self.dropped != failures:
+                    # база снова не принимает вставки — остальное дождётся следующей удачной пачки
+                    return
+        except OSError as e:
+            logger.error(f"Failed to drain spill file {path}: {e}")
+        finally:
+            if offset and os.path.exists(path):
+                try:
+                    self._compact_spill(path, offset)
+                except OSError as e:
+                    logger.error(f"Failed to compact spill file {path}: {e}")
+
+    async def _next_batch(self):
+        """
+        Wait for the first row, then collect more until batch_size or
+        flush_interval. Returns (batch, stop).
+        """
+        item = await self._queue.get()
+        if item is _STOP:
+            return [], True
+
+        batch = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _write(self, batch: list):
+        by_table = defaultdict(list)
+        for table, row in batch:
+            by_table[table].append(row)
+
+        for table, rows in by_table.items():
+            for offset in range(0, len(rows), self.batch_size):
+                await self._insert_with_retry(table, rows[offset:offset + self.batch_size])
+
+    async def _insert_with_retry(self, table: str, rows: list):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.repo.insert(table, rows)
+                self.written += len(rows)
+                if self.spill_path:
+                    self._schedule_drain()
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    await self._on_failure(table, rows, e)
+                    return
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"Insert into {table} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _on_failure(self, table: str, rows: list, error: Exception):
+        logger.error(f"Insert into {table} failed after {self.max_retries} retries: {error}")
+        self._spill_or_drop(table, rows)
+
+    async def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = await self._next_batch()
+            if not batch:
+                continue
+            try:
+                await self._write(batch)
+            except Exception as e:
+                logger.error(f"{self.name} writer failed to write batch: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "dropped": self.dropped,
+            "spilled": self.spilled
+        }
+
+    async def close(self):
+        """Flush everything still queued and stop the background task"""
+        if self._task is None:
+            return
+        self._closing = True
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+            self._drain_task = None
+        logger.info(f"Flushing {self._queue.qsize()} queued rows from {self.name} writer")
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+
+# Логи GEO-запросов в teamN_requests / team8_requests
+request_writer = BatchWriter("requests")
+
+# Не-GEO сообщения в messages: их много, пишем реже и большими пачками
+messages_writer = BatchWriter("messages", batch_size=500, flush_interval=5.0, max_queue=5000)